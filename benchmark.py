@@ -0,0 +1,258 @@
+import argparse
+import asyncio
+import json
+import os
+import random
+import string
+import subprocess
+import tempfile
+import time
+import tracemalloc
+from types import SimpleNamespace
+
+import gnupg
+from fuzzywuzzy import fuzz
+from telegram.ext import SimpleUpdateProcessor
+
+from decrypt_utils import decrypt_file, iter_decrypted_json
+from registration_store import Registration, rows_from_dicts
+from search_index import NameIndex
+from sheets_client import SheetsClient
+from update_processor import ChatOrderedUpdateProcessor
+
+
+# === Fake Sheets service ===
+# Mimics googleapiclient's builder chain with a blocking `execute()` that
+# sleeps for one simulated round trip.
+class FakeRequest:
+    def __init__(self, latency, result):
+        self.latency = latency
+        self.result = result
+
+    def execute(self):
+        time.sleep(self.latency)
+        return self.result
+
+
+class FakeSheetsService:
+    def __init__(self, latency):
+        self.latency = latency
+
+    def spreadsheets(self):
+        return self
+
+    def values(self):
+        return self
+
+    def get(self, **kwargs):
+        return FakeRequest(self.latency, {"values": [["Pickup"], ["Yes"]]})
+
+
+async def _loop_lag(stop):
+    # Worst delay seen by a task that only wants to wake up every 10ms
+    worst = 0.0
+    while not stop.is_set():
+        start = time.perf_counter()
+        await asyncio.sleep(0.01)
+        worst = max(worst, time.perf_counter() - start - 0.01)
+    return worst
+
+
+async def _run_handlers(handler, concurrency):
+    stop = asyncio.Event()
+    lag = asyncio.create_task(_loop_lag(stop))
+    await asyncio.sleep(0)
+    start = time.perf_counter()
+    await asyncio.gather(*(handler() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+    stop.set()
+    return elapsed, await lag
+
+
+# === Scenario: blocking vs pooled Sheets calls ===
+def bench_sheets(args):
+    service = FakeSheetsService(args.latency)
+
+    async def blocking_handler():
+        # What fetch_latest_data() used to do: sync execute() inside a coroutine
+        service.spreadsheets().values().get(spreadsheetId="x", range="A1:Z1000").execute()
+
+    client = SheetsClient(lambda: FakeSheetsService(args.latency), "x", "Sheet1", max_workers=args.workers)
+
+    async def pooled_handler():
+        await client.get_values("A1:Z1000")
+
+    print(f"{args.concurrency} concurrent handlers, {args.latency * 1000:.0f}ms per Sheets call, {args.workers} workers")
+    for label, handler in (("blocking", blocking_handler), ("pooled", pooled_handler)):
+        elapsed, lag = asyncio.run(_run_handlers(handler, args.concurrency))
+        print(f"  {label:<9} total {elapsed * 1000:7.1f}ms   worst event-loop stall {lag * 1000:7.1f}ms")
+    client.close()
+
+
+# === Scenario: fuzzy fallback at scale ===
+def _synthetic_rows(count, seed=7):
+    rng = random.Random(seed)
+    word = lambda: "".join(rng.choices(string.ascii_lowercase, k=rng.randint(4, 9))).title()
+    cities = ["Addison", "Frisco", "Plano", "Allen", "Irving", "Dallas"]
+    return [
+        {
+            "Registrant First Name": word(),
+            "Registrant Last Name": word(),
+            "City": rng.choice(cities),
+            "Attendees": "3",
+            "Additional Family Members": f"{word()} {word()}\n{word()} {word()}",
+            "Bag No.": str(i),
+            "Pickup": "",
+        }
+        for i in range(count)
+    ]
+
+
+def _synthetic_registrations(count, seed=7):
+    return [Registration.from_dict(row) for row in _synthetic_rows(count, seed)]
+
+
+def _typo(name, rng):
+    i = rng.randrange(len(name))
+    return name[:i] + rng.choice(string.ascii_lowercase) + name[i + 1:]
+
+
+def bench_fuzzy(args):
+    rows = _synthetic_registrations(args.rows)
+    start = time.perf_counter()
+    index = NameIndex(rows)
+    build = time.perf_counter() - start
+
+    rng = random.Random(1)
+    queries = [_typo(rng.choice(rows).first_name.lower(), rng) for _ in range(args.queries)]
+
+    start = time.perf_counter()
+    found = sum(1 for q in queries if index.search(q))
+    indexed = (time.perf_counter() - start) / len(queries)
+
+    # Baseline: score every name key, which is what a fuzzy fallback costs
+    # without candidate pruning
+    keys = [key for key, _, _ in index._fuzzy.entries]
+    sample = queries[:max(1, args.queries // 20)]
+    start = time.perf_counter()
+    for q in sample:
+        max(keys, key=lambda k: max(fuzz.ratio(q, k), fuzz.ratio(q, k[:len(q)])))
+    brute = (time.perf_counter() - start) / len(sample)
+
+    print(f"{args.rows} registrations, {len(keys)} name keys, index built in {build:.2f}s")
+    print(f"  indexed search  {indexed * 1000:8.2f}ms/query  ({found}/{len(queries)} typo queries answered)")
+    print(f"  full scan       {brute * 1000:8.2f}ms/query")
+
+
+# === Scenario: decrypt + parse to first query ===
+def _legacy_decrypt_and_load_json(passphrase, path):
+    # decrypt_utils before streaming: a new GPG per call, whole plaintext as str
+    gpg = gnupg.GPG()
+    gpg.encoding = 'utf-8'
+    with open(path, 'rb') as f:
+        decrypted = gpg.decrypt_file(f, passphrase=passphrase, extra_args=["--pinentry-mode", "loopback"])
+    return json.loads(str(decrypted))
+
+
+def _legacy_decrypt_file_then_load(passphrase, path):
+    # What walkathon_bot_2.py used to do: plaintext to disk, then read it back
+    with open(decrypt_file(passphrase, path, path + ".json")) as f:
+        data = json.load(f)
+    os.remove(path + ".json")
+    return data
+
+
+def bench_decrypt(args):
+    passphrase = "benchmark"
+    with tempfile.TemporaryDirectory() as tmp:
+        plain, path = os.path.join(tmp, "data.json"), os.path.join(tmp, "data.json.gpg")
+        with open(plain, "w") as f:
+            json.dump(_synthetic_rows(args.rows), f, indent=2)
+        size = os.path.getsize(plain)
+        subprocess.run(
+            ["gpg", "--batch", "--yes", "--pinentry-mode", "loopback", "--passphrase", passphrase,
+             "-o", path, "-c", plain],
+            check=True, capture_output=True
+        )
+        os.remove(plain)
+
+        loaders = {
+            "decrypt_file + json.load": lambda: rows_from_dicts(_legacy_decrypt_file_then_load(passphrase, path)),
+            "decrypt_and_load_json (old)": lambda: rows_from_dicts(_legacy_decrypt_and_load_json(passphrase, path)),
+            "streamed": lambda: rows_from_dicts(iter_decrypted_json(passphrase, path)),
+        }
+        print(f"{args.rows} registrations, {size / 1e6:.1f}MB of JSON")
+        for label, load in loaders.items():
+            # Time to first query: decrypt, parse, index, answer one lookup
+            start = time.perf_counter()
+            _, rows = load()
+            NameIndex(rows).search(rows[0].first_name)
+            elapsed = time.perf_counter() - start
+            # Peak Python allocations for the load alone (separate run; tracing is slow)
+            tracemalloc.start()
+            load()
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            print(f"  {label:<28} first query after {elapsed * 1000:7.0f}ms   peak {peak / 1e6:6.1f}MB")
+
+
+# === Scenario: concurrent volunteers ===
+async def _drive(processor, chats, per_chat, latency, index, names):
+    # Each volunteer sends `per_chat` messages; arrivals interleave across
+    # chats the way getUpdates returns them. A handler does a real name
+    # lookup plus one simulated round trip (Telegram reply / Sheets write).
+    seen = {chat: [] for chat in range(chats)}
+
+    async def handler(chat, seq):
+        index.search(names[(chat * per_chat + seq) % len(names)])
+        await asyncio.sleep(latency)
+        seen[chat].append(seq)
+
+    start = time.perf_counter()
+    async with processor:
+        tasks = [
+            asyncio.create_task(processor.process_update(
+                SimpleNamespace(effective_chat=SimpleNamespace(id=chat)), handler(chat, seq)
+            ))
+            for seq in range(per_chat) for chat in range(chats)
+        ]
+        await asyncio.gather(*tasks)
+    elapsed = time.perf_counter() - start
+    in_order = all(s == sorted(s) for s in seen.values())
+    return chats * per_chat / elapsed, in_order
+
+
+def bench_load(args):
+    rows = _synthetic_registrations(args.rows)
+    index = NameIndex(rows)
+    names = [row.first_name[:3].lower() for row in rows[:1000]]
+    per_chat = max(1, args.queries // 20)
+    print(f"{per_chat} messages per volunteer, {args.latency * 1000:.0f}ms round trip per message, {args.rows} registrations")
+    for chats in (1, 5, 10, 20, args.concurrency):
+        sequential, _ = asyncio.run(_drive(SimpleUpdateProcessor(1), chats, per_chat, args.latency, index, names))
+        ordered, in_order = asyncio.run(_drive(
+            ChatOrderedUpdateProcessor(), chats, per_chat, args.latency, index, names
+        ))
+        print(
+            f"  {chats:>3} volunteers   sequential {sequential:7.1f} msg/s   "
+            f"per-chat ordered {ordered:7.1f} msg/s   order kept: {'yes' if in_order else 'NO'}"
+        )
+
+
+SCENARIOS = {
+    "load": bench_load,
+    "decrypt": bench_decrypt,
+    "fuzzy": bench_fuzzy,
+    "sheets": bench_sheets,
+}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Micro-benchmarks for the walkathon bot hot paths")
+    parser.add_argument("scenario", choices=sorted(SCENARIOS))
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--latency", type=float, default=0.2)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--rows", type=int, default=50000)
+    parser.add_argument("--queries", type=int, default=200)
+    args = parser.parse_args()
+    SCENARIOS[args.scenario](args)
@@ -1,30 +1,199 @@
+import asyncio
 import gnupg
+import hashlib
 import io
 import json
+import os
+import shutil
+import subprocess
+import threading
+from contextlib import contextmanager
 
-def decrypt_and_load_json(gpg_passphrase, encrypted_path='encrypted_data.json.gpg'):
-    gpg = gnupg.GPG()
-    gpg.encoding = 'utf-8'
+_gpg = None
 
-    with open(encrypted_path, 'rb') as f:
-        decrypted = gpg.decrypt_file(
-            f,
-            passphrase=gpg_passphrase,
-            extra_args=["--pinentry-mode", "loopback"]
-        )
 
-    if not decrypted.ok:
-        raise Exception(f"GPG Decryption Failed: {decrypted.stderr}")
-    
-    # Return parsed JSON directly from decrypted data
-    return json.loads(str(decrypted))
+def gpg_handle():
+    # python-gnupg probes `gpg --version` in its constructor; do that once
+    global _gpg
+    if _gpg is None:
+        _gpg = gnupg.GPG()
+        _gpg.encoding = 'utf-8'
+    return _gpg
+
+
+@contextmanager
+def decrypted_stream(gpg_passphrase, encrypted_path='encrypted_data.json.gpg'):
+    # Text stream of the plaintext, read straight from gpg's stdout. The
+    # passphrase and ciphertext go in on stdin (the same way python-gnupg
+    # feeds them), so nothing decrypted is ever written to disk or held as one
+    # big buffer. `encrypted_path` may also be an open binary file object.
+    proc = subprocess.Popen(
+        [gpg_handle().gpgbinary, "--batch", "--no-tty", "--quiet",
+         "--pinentry-mode", "loopback", "--passphrase-fd", "0", "--decrypt"],
+        stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE
+    )
+    source = encrypted_path if hasattr(encrypted_path, 'read') else open(encrypted_path, 'rb')
+
+    def feed():
+        try:
+            with source as f:
+                proc.stdin.write((gpg_passphrase + "\n").encode())
+                shutil.copyfileobj(f, proc.stdin)
+            proc.stdin.close()
+        except (BrokenPipeError, ValueError):
+            pass  # gpg gave up early (e.g. bad passphrase); reported below
+
+    stderr = []
+    threads = [
+        threading.Thread(target=feed, daemon=True),
+        threading.Thread(target=lambda: stderr.append(proc.stderr.read()), daemon=True),
+    ]
+    for t in threads:
+        t.start()
+
+    def finish(check=True):
+        proc.stdout.close()
+        proc.wait()
+        for t in threads:
+            t.join()
+        if check and proc.returncode != 0:
+            raise Exception(f"GPG Decryption Failed: {b''.join(stderr).decode(errors='replace')}")
+
+    text = io.TextIOWrapper(proc.stdout, encoding='utf-8')
+    try:
+        yield text
+        # Let gpg finish, so a failed integrity check at the end still counts
+        text.read()
+    except GeneratorExit:
+        # The reader stopped early; nothing went wrong
+        proc.kill()
+        finish(check=False)
+        raise
+    except Exception:
+        # A GPG failure explains a parse error better than the parse error does
+        finish()
+        raise
+    finish()
+
+
+def iter_json_array(stream, chunk_size=1 << 16):
+    # Yields the elements of a top-level JSON array as they are read, keeping
+    # only the not-yet-parsed tail of the text in memory
+    decoder = json.JSONDecoder()
+    buf, pos, eof = '', 0, False
+
+    def more():
+        nonlocal buf, pos, eof
+        chunk = stream.read(chunk_size)
+        eof = not chunk
+        buf, pos = buf[pos:] + chunk, 0
+
+    def peek():
+        # Next non-whitespace character, '' at the end of the stream
+        nonlocal pos
+        while True:
+            while pos < len(buf) and buf[pos] in ' \t\r\n':
+                pos += 1
+            if pos < len(buf) or eof:
+                return buf[pos] if pos < len(buf) else ''
+            more()
+
+    if peek() != '[':
+        raise ValueError("Expected the decrypted data to be a JSON array")
+    pos += 1
+    if peek() == ']':
+        return
+    while True:
+        while True:
+            try:
+                value, end = decoder.raw_decode(buf, pos)
+                # A number at the end of the buffer may be cut short ("2." of
+                # "2.5"), so only trust a value followed by a separator
+                if eof or (end < len(buf) and buf[end] in ',] \t\r\n'):
+                    break
+            except ValueError:
+                if eof:
+                    raise
+            more()
+        yield value
+        pos = end
+        sep = peek()
+        if sep == ']':
+            return
+        if sep != ',':
+            raise ValueError(f"Malformed JSON array near: {buf[pos:pos + 40]!r}")
+        pos += 1
+        peek()
+
+
+def iter_decrypted_json(gpg_passphrase, encrypted_path='encrypted_data.json.gpg'):
+    # Registration rows one at a time, parsed while gpg is still decrypting
+    with decrypted_stream(gpg_passphrase, encrypted_path) as stream:
+        yield from iter_json_array(stream)
+
+
+def decrypt_and_load_json(gpg_passphrase, encrypted_path='encrypted_data.json.gpg'):
+    # `encrypted_path` may also be an open binary file object
+    return list(iter_decrypted_json(gpg_passphrase, encrypted_path))
 
 
 def decrypt_file(gpg_passphrase, encrypted_path='encrypted_data.json.gpg', output_path='decrypted_data.json'):
-    gpg = gnupg.GPG()
+    # Writes the plaintext to disk; prefer iter_decrypted_json()
+    gpg = gpg_handle()
     with open(encrypted_path, 'rb') as f:
         decrypted = gpg.decrypt_file(f, passphrase=gpg_passphrase, output=output_path)
         if not decrypted.ok:
             raise Exception(f"GPG Decryption Failed: {decrypted.stderr}")
     return output_path
 
+
+# === Encrypted file watcher ===
+# Notices when encrypted_data.json.gpg is replaced (the sync workflow re-encrypts
+# it every 10 minutes). The cheap mtime/size check runs every poll; only when
+# that moves is the file hashed, and only a new hash is decrypted. Hashing and
+# decryption run in a worker thread so the event loop keeps serving queries.
+class EncryptedDataWatcher:
+    def __init__(self, gpg_passphrase, encrypted_path='encrypted_data.json.gpg'):
+        self.gpg_passphrase = gpg_passphrase
+        self.encrypted_path = encrypted_path
+        self._stamp = None
+        self._digest = None
+        self.reloads = 0
+
+    def _stat(self):
+        st = os.stat(self.encrypted_path)
+        return st.st_mtime_ns, st.st_size
+
+    def _read_if_new(self, transform):
+        stamp = self._stat()
+        with open(self.encrypted_path, 'rb') as f:
+            ciphertext = f.read()
+        digest = hashlib.sha256(ciphertext).hexdigest()
+        if digest == self._digest:
+            # Touched (e.g. a checkout) but same content
+            self._stamp = stamp
+            return None
+        # Decrypt the bytes we hashed, not whatever is on disk by now
+        data = transform(iter_decrypted_json(self.gpg_passphrase, io.BytesIO(ciphertext)))
+        self._stamp, self._digest = stamp, digest
+        return data
+
+    def load(self, transform=list):
+        # Blocking first load, for start-up
+        return self._read_if_new(transform)
+
+    async def changed(self, transform=list):
+        # transform(rows) for a new version of the file, None if unchanged.
+        # `rows` is an iterator, so the transform can parse as gpg decrypts.
+        try:
+            if self._stat() == self._stamp:
+                return None
+        except OSError as e:
+            print(f"❌ Cannot stat {self.encrypted_path}: {e}")
+            return None
+        loop = asyncio.get_running_loop()
+        result = await loop.run_in_executor(None, self._read_if_new, transform)
+        if result is not None:
+            self.reloads += 1
+            print(f"🔁 {self.encrypted_path} changed; reloaded.")
+        return result
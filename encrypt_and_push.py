@@ -1,9 +1,15 @@
 import os
 import base64
+import hashlib
+import hmac
 import json
-import subprocess
+from collections import Counter
+
+import gnupg
 from google.oauth2 import service_account
 from googleapiclient.discovery import build
+from decrypt_utils import decrypt_and_load_json
+from sheets_client import SheetsClient
 
 # Load and decode service account JSON
 
@@ -19,27 +25,90 @@ scopes = ['https://www.googleapis.com/auth/spreadsheets.readonly']
 creds = service_account.Credentials.from_service_account_file("temp_creds.json", scopes=scopes)
 service = build('sheets', 'v4', credentials=creds)
 
-# Read Sheet
+# Read Sheet (paged over the tab's real size, not a fixed A1:Z1000 window)
 sheet_id = os.getenv('GOOGLE_SHEET_ID')
-range_name = "'01-01-2025 to 05-02-2025'!A1:Z1000"
-result = service.spreadsheets().values().get(spreadsheetId=sheet_id, range=range_name).execute()
-values = result.get("values", [])
+sheet_name = os.getenv('SHEET_NAME', '01-01-2025 to 05-02-2025')
+client = SheetsClient(lambda: service, sheet_id, sheet_name, max_workers=1)
+
+headers = None
+data = []
+for page in client.iter_pages(int(os.getenv('SHEET_PAGE_ROWS', '500'))):
+    if headers is None:
+        headers, page = page[0], page[1:]
+    data.extend(dict(zip(headers, row)) for row in page)
+client.close()
+
+# Canonical serialization: same registrations -> byte-identical JSON -> same hash.
+# Row order is kept, since the bots address rows by position, and keys stay
+# in sheet header order, which the bots read the column order back from.
+canonical = json.dumps(data, separators=(',', ':'), ensure_ascii=False)
+passphrase = os.getenv("GPG_PASSPHRASE")
+# Keyed so the committed hash can't be used to confirm guesses about the data
+content_hash = hmac.new(passphrase.encode(), canonical.encode(), hashlib.sha256).hexdigest()
+
+encrypted_path = "encrypted_data.json.gpg"
+hash_path = encrypted_path + ".sha256"
+previous_hash = open(hash_path).read().strip() if os.path.exists(hash_path) else None
+
+
+def set_output(name, value):
+    # Step outputs for the workflow; a no-op when run by hand
+    if os.getenv("GITHUB_OUTPUT"):
+        with open(os.getenv("GITHUB_OUTPUT"), "a") as f:
+            f.write(f"{name}={value}\n")
+
+
+def row_key(row):
+    # Same identity as registration_store.KEY_COLUMNS, without pulling in the
+    # bot's search dependencies here
+    return tuple(row.get(col, '') for col in ('Registrant First Name', 'Registrant Last Name', 'City'))
+
+
+def diff_summary(old, new):
+    # Rows matched on (first, last, city); repeats of a key pair up in order
+    def keyed(rows):
+        seen = Counter()
+        out = {}
+        for row in rows:
+            key = row_key(row)
+            out[key + (seen[key],)] = row
+            seen[key] += 1
+        return out
+    old, new = keyed(old), keyed(new)
+    added = len(new.keys() - old.keys())
+    removed = len(old.keys() - new.keys())
+    changed = sum(1 for key in new.keys() & old.keys() if new[key] != old[key])
+    return f"{added} added, {removed} removed, {changed} changed"
 
-headers = values[0]
-data = [dict(zip(headers, row)) for row in values[1:]]
 
-# Save JSON
-with open("data.json", "w") as f:
-    json.dump(data, f, indent=2)
+if content_hash == previous_hash:
+    print("✅ Registration data unchanged; skipping encryption.")
+    set_output("changed", "false")
+    raise SystemExit(0)
 
-# Encrypt with GPG
-gpg_input = os.getenv('GPG_PRIVATE_KEY')
-with open("private.key", "w") as f:
-    f.write(gpg_input)
+try:
+    summary = diff_summary(decrypt_and_load_json(passphrase, encrypted_path), data)
+except Exception as e:
+    # First run, or the old file can't be read; just say how big the new one is
+    print(f"⚠️ Could not diff against the previous export: {e}")
+    summary = f"{len(data)} rows"
+print(f"🔁 Registration data changed: {summary}")
 
-subprocess.run(["gpg", "--batch", "--import", "private.key"])
-subprocess.run([
-    "gpg", "--batch", "--yes", "--passphrase", os.getenv("GPG_PASSPHRASE"),
-    "-o", "encrypted_data.json.gpg", "-c", "data.json"
-])
+# Symmetric encryption straight from memory; no plaintext data.json on disk
+gpg = gnupg.GPG()
+encrypted = gpg.encrypt(
+    canonical.encode(), None,
+    symmetric=True,
+    passphrase=passphrase,
+    armor=False,
+    extra_args=["--pinentry-mode", "loopback"]
+)
+if not encrypted.ok:
+    raise Exception(f"GPG Encryption Failed: {encrypted.status}")
+with open(encrypted_path, "wb") as f:
+    f.write(encrypted.data)
+with open(hash_path, "w") as f:
+    f.write(content_hash + "\n")
 
+set_output("changed", "true")
+set_output("summary", summary)
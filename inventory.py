@@ -0,0 +1,54 @@
+from registration_store import SHIRT_SIZES
+
+
+def parse_stock(spec):
+    # "SM=120, MD=200, Y-XS=15" -> {"SM": 120, "MD": 200, "Y-XS": 15}
+    stock = {}
+    for part in (spec or "").split(","):
+        if not part.strip():
+            continue
+        size, _, count = part.partition("=")
+        size = size.strip().upper()
+        if size not in SHIRT_SIZES or not count.strip().isdigit():
+            print(f"⚠️ Ignoring shirt stock entry: {part.strip()!r}")
+            continue
+        stock[size] = int(count)
+    return stock
+
+
+# === T-shirt Inventory ===
+# Starting stock per size against the snapshot's PickupTally. Shirts leave the
+# stock when their bag is marked picked up ("yes"), and come back if the mark
+# is removed, because the tally already follows every pickup change; nothing
+# here rescans the rows.
+class ShirtInventory:
+    def __init__(self, stock, low_threshold=10):
+        self.stock = stock
+        self.low_threshold = low_threshold
+        self._alerted = set()  # sizes currently reported as low
+
+    def levels(self, tally):
+        # (size, stock or None, handed out, left or None, still owed) per size
+        # that is stocked or ordered, in SHIRT_SIZES order
+        levels = []
+        for size in SHIRT_SIZES:
+            if size not in self.stock and not tally.shirts_ordered[size]:
+                continue
+            given = tally.shirts_given[size]
+            owed = tally.shirts_ordered[size] - given
+            stock = self.stock.get(size)
+            left = stock - given if stock is not None else None
+            levels.append((size, stock, given, left, owed))
+        return levels
+
+    def newly_low(self, tally):
+        # Sizes that dropped to the threshold since the last call. A size is
+        # reported once, and again only after it has gone back above it.
+        levels = self.levels(tally)
+        low = {
+            size for size, stock, _, left, _ in levels
+            if stock is not None and left <= self.low_threshold
+        }
+        fresh = low - self._alerted
+        self._alerted = low
+        return [level for level in levels if level[0] in fresh]
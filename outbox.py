@@ -0,0 +1,242 @@
+import asyncio
+import heapq
+import itertools
+import re
+import time
+
+from telegram.error import RetryAfter
+
+# Lower sends first
+PRIORITY_CONFIRM = 0  # pickup / check-in confirmations
+PRIORITY_REPLY = 1    # ordinary replies and prompts
+PRIORITY_BULK = 2     # long match lists, breakdowns
+
+# Legacy Markdown markers that must come in pairs within one message
+_MARKERS = ("*", "_", "`")
+_ESCAPED = re.compile(r"\\.")
+
+
+def _open_markers(text):
+    # Markers left open at the end of `text`, in the order they were opened
+    stack = []
+    for ch in _ESCAPED.sub("", text):
+        if ch in _MARKERS:
+            if stack and stack[-1] == ch:
+                stack.pop()
+            elif ch in stack:
+                # Crossed markers (*a _b* c_); close the inner one too
+                while stack and stack.pop() != ch:
+                    pass
+            else:
+                stack.append(ch)
+    return stack
+
+
+def _split_line(line, limit):
+    # A single line longer than `limit`: break at spaces where possible, and
+    # close any marker left open at a break, reopening it on the next piece
+    pieces, reopen = [], ""
+    while len(reopen) + len(line) > limit:
+        room = limit - len(reopen) - len(_MARKERS)
+        cut = line.rfind(" ", 0, room)
+        if cut <= 0:
+            cut = room
+        piece = reopen + line[:cut]
+        line = line[cut:].lstrip(" ")
+        open_markers = _open_markers(piece)
+        pieces.append(piece + "".join(reversed(open_markers)))
+        reopen = "".join(open_markers)
+    pieces.append(reopen + line)
+    return pieces
+
+
+def split_message(text, limit=4000):
+    # Chunks of at most `limit` characters, broken between lines. Each line is
+    # looked at once and every chunk is joined once, so this is linear in the
+    # length of the text.
+    chunks, current, size = [], [], 0
+    for line in text.strip().split("\n"):
+        for piece in _split_line(line, limit) if len(line) > limit else (line,):
+            if current and size + 1 + len(piece) > limit:
+                chunks.append("\n".join(current).strip())
+                current, size = [], 0
+            size += len(piece) + (1 if current else 0)
+            current.append(piece)
+    if current:
+        chunks.append("\n".join(current).strip())
+    return [chunk for chunk in chunks if chunk]
+
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.stamp = time.monotonic()
+        self.blocked_until = 0.0
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def wait_time(self):
+        now = time.monotonic()
+        self._refill(now)
+        wait = 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+        return max(wait, self.blocked_until - now)
+
+    def take(self):
+        self._refill(time.monotonic())
+        self.tokens -= 1
+
+    def block(self, seconds):
+        # Telegram said retry_after; nothing goes out before then
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+
+class OutgoingMessage:
+    __slots__ = ('priority', 'seq', 'chat_id', 'method', 'kwargs', 'future', 'attempts')
+
+    def __init__(self, priority, seq, chat_id, method, kwargs, future):
+        self.priority = priority
+        self.seq = seq
+        self.chat_id = chat_id
+        self.method = method  # Bot method name, e.g. "send_message"
+        self.kwargs = kwargs
+        self.future = future
+        self.attempts = 0
+
+    def __lt__(self, other):
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+
+# === Outbox ===
+# Every outgoing message goes through one dispatcher that respects Telegram's
+# flood limits: a global token bucket (~30 msg/s per bot) and one bucket per
+# chat (~1 msg/s sustained, small bursts allowed). Each chat has its own
+# priority queue and at most one message in flight, so its messages keep their
+# order; across chats, the best-priority message whose chat is ready goes
+# next, so a pickup confirmation is not stuck behind another table's
+# 40-chunk match list. A 429 pauses all sending for `retry_after` (as PTB's
+# own rate limiter does) and the message is retried in place. Edits to a
+# message count against the same limits, so they queue here too.
+class Outbox:
+    def __init__(self, bot, global_rate=25, chat_rate=1.0, chat_burst=3, max_retries=3):
+        self.bot = bot
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self._global = TokenBucket(global_rate, global_rate)
+        self._chats = {}    # chat_id -> heap of OutgoingMessage
+        self._buckets = {}  # chat_id -> TokenBucket
+        self._busy = set()  # chats with a message in flight
+        self._seq = itertools.count()
+        self._wakeup = asyncio.Event()
+        self._dispatcher = None
+        self.sent = 0
+        self.retried = 0
+
+    def __len__(self):
+        return sum(len(queue) for queue in self._chats.values())
+
+    async def send(self, chat_id, text, priority=PRIORITY_REPLY, **kwargs):
+        # Resolves to the sent Message, or raises what the last attempt raised
+        message = self._enqueue(chat_id, "send_message", dict(kwargs, text=text), priority)
+        return await message.future
+
+    async def send_split(self, chat_id, text, priority=PRIORITY_BULK, limit=4000, **kwargs):
+        # All chunks are queued up front, so they go out back to back
+        messages = [
+            self._enqueue(chat_id, "send_message", dict(kwargs, text=chunk), priority)
+            for chunk in split_message(text, limit)
+        ]
+        return [await message.future for message in messages]
+
+    async def edit(self, chat_id, message_id, text=None, priority=PRIORITY_REPLY, **kwargs):
+        # New text (and markup) for a sent message, or only its markup when
+        # `text` is None
+        kwargs["message_id"] = message_id
+        if text is None:
+            message = self._enqueue(chat_id, "edit_message_reply_markup", kwargs, priority)
+        else:
+            message = self._enqueue(chat_id, "edit_message_text", dict(kwargs, text=text), priority)
+        return await message.future
+
+    def _enqueue(self, chat_id, method, kwargs, priority):
+        message = OutgoingMessage(
+            priority, next(self._seq), chat_id, method, kwargs, asyncio.get_running_loop().create_future()
+        )
+        heapq.heappush(self._chats.setdefault(chat_id, []), message)
+        if self._dispatcher is None or self._dispatcher.done():
+            self._dispatcher = asyncio.create_task(self._dispatch())
+        self._wakeup.set()
+        return message
+
+    def _bucket(self, chat_id):
+        bucket = self._buckets.get(chat_id)
+        if bucket is None:
+            bucket = self._buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+
+    def _next_ready(self):
+        # Best queued message whose chat may send now, or the time until one can
+        best, wait = None, None
+        for chat_id, queue in self._chats.items():
+            if chat_id in self._busy:
+                continue
+            delay = self._bucket(chat_id).wait_time()
+            if delay > 0:
+                wait = delay if wait is None else min(wait, delay)
+            elif best is None or queue[0] < best:
+                best = queue[0]
+        return best, wait
+
+    async def _dispatch(self):
+        while self._chats:
+            self._wakeup.clear()
+            delay = self._global.wait_time()
+            message, wait = (None, None) if delay > 0 else self._next_ready()
+            if message is None:
+                wait = delay if delay > 0 else wait
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), wait)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            queue = self._chats[message.chat_id]
+            heapq.heappop(queue)
+            if not queue:
+                del self._chats[message.chat_id]
+            self._global.take()
+            self._bucket(message.chat_id).take()
+            self._busy.add(message.chat_id)
+            asyncio.create_task(self._deliver(message))
+
+    async def _deliver(self, message):
+        try:
+            if message.future.done():
+                return  # the caller gave up waiting
+            result = await getattr(self.bot, message.method)(chat_id=message.chat_id, **message.kwargs)
+            self.sent += 1
+            if not message.future.done():
+                message.future.set_result(result)
+        except RetryAfter as e:
+            message.attempts += 1
+            print(f"⏳ Telegram flood limit hit sending to {message.chat_id}; pausing {e.retry_after}s")
+            self._global.block(e.retry_after)
+            self._bucket(message.chat_id).block(e.retry_after)
+            if message.attempts > self.max_retries:
+                if not message.future.done():
+                    message.future.set_exception(e)
+            else:
+                self.retried += 1
+                # Same priority and seq, so it goes back to the front of its chat
+                heapq.heappush(self._chats.setdefault(message.chat_id, []), message)
+        except Exception as e:
+            if not message.future.done():
+                message.future.set_exception(e)
+        finally:
+            self._busy.discard(message.chat_id)
+            if self._chats and (self._dispatcher is None or self._dispatcher.done()):
+                self._dispatcher = asyncio.create_task(self._dispatch())
+            self._wakeup.set()
@@ -0,0 +1,456 @@
+import asyncio
+import time
+from collections import Counter
+
+from search_index import BagIndex, NameIndex
+
+
+KEY_COLUMNS = ('Registrant First Name', 'Registrant Last Name', 'City')
+PICKUP_COLUMN = 'Pickup'
+SHIRT_SIZES = ("SM", "MD", "LG", "XL", "XXL", "Y-LG", "Y-MD", "Y-SM", "Y-XS")
+
+
+def _count(value):
+    try:
+        return int(value) if value else 0
+    except ValueError:
+        return 0
+
+
+# === Registration ===
+# One sheet row, parsed once at load time. Only the columns the bot uses are
+# kept, and shirt counts, attendees, family lines and the pickup state are
+# already in the shape formatting and counting need, so nothing re-parses
+# strings per request.
+class Registration:
+    __slots__ = (
+        'first_name', 'last_name', 'city', 'attendees', 'family',
+        'bag_no', 'shirts', '_pickup', 'pickup_state',
+    )
+
+    def __init__(self, first_name, last_name, city, attendees, family, bag_no, shirts, pickup):
+        self.first_name = first_name
+        self.last_name = last_name
+        self.city = city
+        self.attendees = attendees  # int, or None if the cell isn't a number
+        self.family = family        # tuple of stripped, non-empty lines
+        self.bag_no = bag_no        # stripped, '' when unassigned
+        self.shirts = shirts        # ((size, count), ...) for sizes ordered, in SHIRT_SIZES order
+        self.pickup = pickup
+
+    @property
+    def pickup(self):
+        # Raw cell value, as written to / read from the sheet
+        return self._pickup
+
+    @pickup.setter
+    def pickup(self, value):
+        self._pickup = value
+        self.pickup_state = value.strip().lower()  # "yes", "no" or ""
+
+    def __reduce__(self):
+        # Pickled as its constructor arguments; pickup_state is derived
+        return Registration, (
+            self.first_name, self.last_name, self.city, self.attendees,
+            self.family, self.bag_no, self.shirts, self._pickup,
+        )
+
+    @property
+    def key(self):
+        return (self.first_name, self.last_name, self.city)
+
+    @property
+    def full_name(self):
+        return f"{self.first_name} {self.last_name}"
+
+    @property
+    def total_shirts(self):
+        return sum(count for _, count in self.shirts)
+
+    @classmethod
+    def from_cells(cls, positions, cells):
+        # `positions` maps header -> 0-based index into `cells` (one sheet row)
+        def cell(header):
+            i = positions.get(header)
+            return cells[i] if i is not None and i < len(cells) else ''
+        return cls._parse(cell)
+
+    @classmethod
+    def from_dict(cls, row):
+        return cls._parse(lambda header: row.get(header, ''))
+
+    @classmethod
+    def _parse(cls, cell):
+        attendees = cell('Attendees').strip()
+        shirts = tuple(
+            (size, count) for size, count in ((size, _count(cell(size))) for size in SHIRT_SIZES)
+            if count > 0
+        )
+        return cls(
+            cell('Registrant First Name'),
+            cell('Registrant Last Name'),
+            cell('City'),
+            int(attendees) if attendees.isdigit() else None,
+            tuple(line.strip() for line in cell('Additional Family Members').split('\n') if line.strip()),
+            cell('Bag No.').strip(),
+            shirts,
+            cell(PICKUP_COLUMN),
+        )
+
+
+def header_positions(headers):
+    positions = {}
+    for i, header in enumerate(headers):
+        positions.setdefault(header, i)
+    return positions
+
+
+def rows_from_values(headers, values):
+    positions = header_positions(headers)
+    return [Registration.from_cells(positions, cells) for cells in values]
+
+
+def headers_from_dicts(rows):
+    # The decrypted JSON has no header row; recover the column order from the dicts
+    headers = {}
+    for row in rows:
+        headers.update(dict.fromkeys(row))
+    return list(headers)
+
+
+def rows_from_dicts(data):
+    # Decrypted JSON -> the (headers, rows) pair a store fetch returns. One
+    # pass, so `data` can be a stream of rows that is never held as a list.
+    headers, rows = {}, []
+    for row in data:
+        headers.update(dict.fromkeys(row))
+        rows.append(Registration.from_dict(row))
+    return list(headers), rows
+
+
+# === Pickup Tally ===
+# Running pickup counts for one snapshot: rows and attendees per pickup state,
+# rows per city and state, and shirts ordered / handed out per size. Every
+# pickup change goes through Snapshot.set_pickup, which takes the row out of
+# the tally under its old state and puts it back under the new one, so
+# /summary is a few dict reads instead of a pass over the sheet.
+class PickupTally:
+    def __init__(self, rows):
+        self.rows = Counter()       # pickup state -> rows
+        self.attendees = Counter()  # pickup state -> attendees
+        self.cities = {}            # city -> Counter(pickup state -> rows)
+        self.shirts_ordered = Counter()
+        self.shirts_given = Counter()
+        for row in rows:
+            self.add(row)
+
+    def add(self, row, sign=1):
+        state = row.pickup_state
+        self.rows[state] += sign
+        self.attendees[state] += sign * (row.attendees or 0)
+        city = row.city.strip().title() or '?'
+        self.cities.setdefault(city, Counter())[state] += sign
+        for size, count in row.shirts:
+            self.shirts_ordered[size] += sign * count
+            if state == "yes":
+                self.shirts_given[size] += sign * count
+
+    def remove(self, row):
+        self.add(row, -1)
+
+    def shirts_owed(self):
+        # Per size, in SHIRT_SIZES order, sizes with nothing ordered left out
+        return [
+            (size, self.shirts_ordered[size] - self.shirts_given[size])
+            for size in SHIRT_SIZES if self.shirts_ordered[size]
+        ]
+
+
+# === Row Locator ===
+# Row -> sheet row number, plus header -> 1-based column position. Rows sit in
+# sheet order under a single header row, so data row i lives on sheet row
+# i + 2. A row from this snapshot is located by its position; a row from an
+# older one by its identity (first, last, city), unless several rows share
+# that identity, in which case there is no telling which one it was.
+class RowLocator:
+    def __init__(self, headers, rows):
+        self.columns = {}
+        for col, header in enumerate(headers, start=1):
+            self.columns.setdefault(header, col)
+        self._positions = {}  # row -> sheet row
+        self._by_key = {}     # identity -> sheet row, None when ambiguous
+        for i, row in enumerate(rows):
+            self.add(i, row)
+
+    def add(self, i, row):
+        self._positions[row] = i + 2
+        self._by_key[row.key] = None if row.key in self._by_key else i + 2
+
+    def locate(self, row):
+        sheet_row = self._positions.get(row)
+        return sheet_row if sheet_row is not None else self._by_key.get(row.key)
+
+    def key_span(self):
+        # Leftmost and rightmost key column, for a one-row verification read
+        cols = [self.columns[c] for c in KEY_COLUMNS if c in self.columns]
+        return (min(cols), max(cols)) if len(cols) == len(KEY_COLUMNS) else None
+
+
+# === Snapshot ===
+# The registration rows as of one full sheet read. A full refresh swaps in a
+# whole new Snapshot, so handlers holding a reference never see a half-loaded
+# list. Pickup writes and incremental syncs patch the rows in place and only
+# ever append, which keeps every row id and index entry valid.
+class Snapshot:
+    def __init__(self, headers, rows, version, loaded_at, source):
+        self.headers = headers
+        self.rows = rows
+        self.version = version
+        self.loaded_at = loaded_at  # when the sheet read this reflects started
+        self.source = source  # "sheet", "warm-start" or "cold-start"
+        self.names = NameIndex(rows)
+        self.bags = BagIndex(rows)
+        self.locator = RowLocator(headers, rows)
+        self.tally = PickupTally(rows)
+
+    def __getstate__(self):
+        # Only the rows go into the warm-start cache; the indexes are rebuilt
+        # on load. The list is copied in one step because this runs in a
+        # worker thread while the loop may append to it.
+        return (self.headers, list(self.rows), self.version, self.loaded_at, self.source)
+
+    def __setstate__(self, state):
+        self.__init__(*state)
+
+    def age(self):
+        return time.time() - self.loaded_at
+
+    def set_pickup(self, row, value):
+        # `row` must be one of self.rows
+        self.tally.remove(row)
+        row.pickup = value
+        self.tally.add(row)
+
+    def apply_delta(self, pickups, first_names, appended, loaded_at):
+        # `pickups` / `first_names` are the Pickup and first-name columns below
+        # the header, `appended` the full rows past the ones we hold, read
+        # from `loaded_at`. Returns the number of rows changed, or None when
+        # the sheet no longer lines up (rows inserted, deleted or sorted) and a
+        # full reload is needed.
+        held = len(self.rows)
+        if len(first_names) < held:
+            first_names = first_names + [''] * (held - len(first_names))
+        for row, name in zip(self.rows, first_names):
+            if row.first_name != name:
+                return None
+        if len(first_names) - held != len(appended):
+            return None
+
+        changed = 0
+        for i, row in enumerate(self.rows):
+            value = pickups[i] if i < len(pickups) else ''
+            if row.pickup != value:
+                self.set_pickup(row, value)
+                changed += 1
+        positions = header_positions(self.headers)
+        for cells in appended:
+            row = Registration.from_cells(positions, cells)
+            rid = len(self.rows)
+            self.rows.append(row)
+            self.names.add(rid, row)
+            self.bags.add(row)
+            self.locator.add(rid, row)
+            self.tally.add(row)
+        self.loaded_at = loaded_at
+        return changed + len(appended)
+
+
+# === Store ===
+class RegistrationStore:
+    def __init__(self, fetch, initial_data=None, freshness=0, fetch_delta=None, full_sync_every=20, snapshot=None):
+        self._fetch = fetch
+        # Optional narrow read used between full loads; see Snapshot.apply_delta
+        self._fetch_delta = fetch_delta
+        self.full_sync_every = full_sync_every
+        self._deltas_since_full = 0
+        self._refresh_task = None
+        self._inflight = None
+        self.freshness = freshness  # seconds within which a snapshot counts as fresh
+        self.refresh_hits = 0       # answered from a fresh snapshot, no fetch
+        self.refresh_joins = 0      # piggy-backed on a fetch already in flight
+        self.refresh_misses = 0     # started a new fetch
+        self._listeners = []
+        if snapshot is not None:
+            # Restored from the warm-start cache, indexes and all. Never counts
+            # as fresh, so the first refresh is a full reconcile with the sheet.
+            snapshot.source = "warm-start"
+            self.snapshot = snapshot
+        else:
+            # `initial_data` is the decrypted JSON (a list of header -> value dicts)
+            initial_data = initial_data or []
+            self.snapshot = Snapshot(
+                headers_from_dicts(initial_data),
+                [Registration.from_dict(row) for row in initial_data],
+                0, 0.0, "cold-start"
+            )
+        if self.snapshot.bags.duplicates:
+            print(f"⚠️ Duplicate bag numbers in sheet: {', '.join(sorted(self.snapshot.bags.duplicates))}")
+
+    @property
+    def rows(self):
+        return self.snapshot.rows
+
+    @property
+    def version(self):
+        return self.snapshot.version
+
+    def replace(self, headers, rows, source="sheet"):
+        return self._swap(Snapshot(headers, rows, 0, time.time(), source))
+
+    def _swap(self, snapshot):
+        previous = self.snapshot
+        previous_duplicates = sorted(previous.bags.duplicates)
+        snapshot.version = previous.version + 1
+        self.snapshot = snapshot
+        self._changed(previous_duplicates)
+        return self.snapshot
+
+    def _changed(self, previous_duplicates):
+        duplicates = sorted(self.snapshot.bags.duplicates)
+        if duplicates != previous_duplicates:
+            if duplicates:
+                print(f"⚠️ Duplicate bag numbers in sheet: {', '.join(duplicates)}")
+            else:
+                print("✅ Duplicate bag numbers resolved.")
+        for listener in self._listeners:
+            listener(self.snapshot)
+
+    def add_listener(self, listener):
+        # Called with the snapshot after every swap or in-place sync that changed it
+        self._listeners.append(listener)
+
+    def counterpart(self, row):
+        # `row`'s registration in the current snapshot: `row` itself if it
+        # belongs there, None if it is gone or its identity is ambiguous
+        sheet_row = self.snapshot.locator.locate(row)
+        return None if sheet_row is None else self.snapshot.rows[sheet_row - 2]
+
+    def patch_pickup(self, row, value):
+        # `row` may belong to an older snapshot (e.g. held by a session), so
+        # update both it and its counterpart in the current one. The
+        # counterpart goes through set_pickup so the tally follows; `row`
+        # itself only needs the value when it is not that counterpart.
+        current = self.counterpart(row)
+        if current is not None:
+            self.snapshot.set_pickup(current, value)
+        if current is not row:
+            row.pickup = value
+        # Anything rendered from the old value (cached replies) is now stale
+        self.snapshot.version += 1
+
+    def request_full_sync(self):
+        # Make the next refresh re-read the whole sheet instead of a delta
+        self._deltas_since_full = self.full_sync_every
+
+    def is_fresh(self, max_age):
+        snapshot = self.snapshot
+        return snapshot.source == "sheet" and snapshot.age() < max_age
+
+    async def refresh(self, max_age=None):
+        # Single-flight: at most one fetch runs at a time and every concurrent
+        # caller awaits the same future. With `max_age`, a snapshot younger
+        # than that is returned as-is without fetching at all.
+        if max_age is not None and self.is_fresh(max_age):
+            self.refresh_hits += 1
+            return self.snapshot
+        if self._inflight is not None and not self._inflight.done():
+            self.refresh_joins += 1
+        else:
+            self.refresh_misses += 1
+            self._inflight = asyncio.ensure_future(self._load())
+        # Shielded so one cancelled caller doesn't abort the shared fetch
+        return await asyncio.shield(self._inflight)
+
+    def refresh_soon(self):
+        # Stale-while-revalidate for handlers: never waits, at most one fetch
+        # per freshness window however many messages arrive.
+        if self.is_fresh(self.freshness):
+            self.refresh_hits += 1
+        elif self._inflight is not None and not self._inflight.done():
+            self.refresh_joins += 1
+        else:
+            self.refresh_misses += 1
+            self._inflight = asyncio.ensure_future(self._load())
+        return self.snapshot
+
+    def refresh_stats(self):
+        calls = self.refresh_hits + self.refresh_joins + self.refresh_misses
+        saved = self.refresh_hits + self.refresh_joins
+        return {
+            "hits": self.refresh_hits,
+            "joins": self.refresh_joins,
+            "misses": self.refresh_misses,
+            "saved_ratio": saved / calls if calls else 0.0,
+        }
+
+    async def _load(self):
+        snapshot = self.snapshot
+        if (
+            self._fetch_delta is not None
+            and snapshot.source == "sheet"
+            and self._deltas_since_full < self.full_sync_every
+        ):
+            started = time.time()
+            try:
+                delta = await self._fetch_delta(snapshot)
+            except Exception as e:
+                print(f"❌ Incremental sync failed: {e}")
+                delta = None
+            if snapshot is not self.snapshot:
+                # A full reload landed while we were waiting; nothing to patch
+                return self.snapshot
+            if delta is not None:
+                duplicates = sorted(snapshot.bags.duplicates)
+                changed = snapshot.apply_delta(*delta, started)
+                if changed is not None:
+                    self._deltas_since_full += 1
+                    if changed:
+                        snapshot.version += 1
+                        self._changed(duplicates)
+                    return snapshot
+                print("🔁 Sheet layout changed; doing a full reload.")
+
+        started = time.time()
+        try:
+            loaded = await self._fetch()
+        except Exception as e:
+            print(f"❌ Snapshot refresh failed: {e}")
+            return self.snapshot
+        # An empty fetch means the sheet call failed; keep serving what we have.
+        if loaded:
+            # Index building is pure CPU; keep it off the event loop as well
+            headers, rows = loaded
+            loop = asyncio.get_running_loop()
+            self._swap(await loop.run_in_executor(None, Snapshot, headers, rows, 0, started, "sheet"))
+            self._deltas_since_full = 0
+        return self.snapshot
+
+    async def _refresh_loop(self, interval):
+        while True:
+            # Skips the fetch if a handler-triggered refresh just landed
+            await self.refresh(max_age=self.freshness)
+            await asyncio.sleep(interval)
+
+    def start_background_refresh(self, interval):
+        if self._refresh_task is None or self._refresh_task.done():
+            self._refresh_task = asyncio.create_task(self._refresh_loop(interval))
+        return self._refresh_task
+
+    async def stop_background_refresh(self):
+        if self._refresh_task is not None:
+            self._refresh_task.cancel()
+            try:
+                await self._refresh_task
+            except asyncio.CancelledError:
+                pass
+            self._refresh_task = None
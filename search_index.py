@@ -0,0 +1,225 @@
+import heapq
+from bisect import bisect_left, bisect_right
+from collections import Counter, OrderedDict
+
+from fuzzywuzzy import fuzz
+
+
+def _prefix_end(prefix):
+    # Smallest string that sorts after every string starting with `prefix`
+    return prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+
+def _prefix_range(keys, prefix):
+    lo = bisect_left(keys, prefix)
+    if not prefix:
+        return lo, len(keys)
+    return lo, bisect_left(keys, _prefix_end(prefix), lo)
+
+
+def _trigrams(text):
+    padded = f"  {text} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+# === Fuzzy Index ===
+# Trigram inverted index over the same name keys as NameIndex. A typo'd query
+# only gets scored against the few hundred keys sharing the most trigrams
+# with it, instead of running fuzz.ratio over every name in the sheet.
+class FuzzyIndex:
+    def __init__(self):
+        self.entries = []    # (key, rid, matched family line or None)
+        self._postings = {}  # trigram -> [entry ids]
+
+    def add(self, key, rid, line=None):
+        eid = len(self.entries)
+        self.entries.append((key, rid, line))
+        for gram in _trigrams(key):
+            self._postings.setdefault(gram, []).append(eid)
+
+    def candidates(self, query, keep, limit):
+        # Entry ids sharing at least a third of the query's trigrams, best
+        # overlap first; `keep(rid)` filters (e.g. by city) before the cut.
+        grams = _trigrams(query)
+        counts = Counter()
+        for gram in grams:
+            counts.update(self._postings.get(gram, ()))
+        need = max(1, len(grams) // 3)
+        pool = [(n, eid) for eid, n in counts.items() if n >= need and keep(self.entries[eid][1])]
+        return [eid for _, eid in heapq.nlargest(limit, pool)]
+
+
+# === Name Index ===
+# Sorted key arrays over first name, last name, "first last" and every
+# additional family member line. A prefix lookup is two bisects per array
+# instead of lowercasing and splitting every row on every query.
+class NameIndex:
+    def __init__(self, rows):
+        self.rows = rows
+        self._cities = []
+        self._sort_names = []
+        self._fuzzy = FuzzyIndex()
+        direct = []
+        family = []
+
+        for rid, row in enumerate(rows):
+            d, f = self._keys(rid, row)
+            direct += d
+            family += f
+
+        direct.sort()
+        family.sort()
+        self._direct_keys = [k for k, _ in direct]
+        self._direct_ids = [rid for _, rid in direct]
+        self._family_keys = [f[0] for f in family]
+        self._family_hits = [f[1:] for f in family]
+
+    def _keys(self, rid, row):
+        # Also records the per-row city and sort name, so call in rid order
+        fname = row.first_name.lower()
+        lname = row.last_name.lower()
+        self._cities.append(row.city.lower())
+        self._sort_names.append(row.first_name)
+        direct = [(fname, rid), (lname, rid), (f"{fname} {lname}", rid)]
+        family = [(line.lower(), rid, pos, line) for pos, line in enumerate(row.family)]
+        for key, _ in direct:
+            self._fuzzy.add(key, rid)
+        for key, _, _, line in family:
+            self._fuzzy.add(key, rid, line)
+        return direct, family
+
+    def add(self, rid, row):
+        # For rows appended to `self.rows` after the index was built
+        direct, family = self._keys(rid, row)
+        for key, _ in direct:
+            at = bisect_right(self._direct_keys, key)
+            self._direct_keys.insert(at, key)
+            self._direct_ids.insert(at, rid)
+        for key, *hit in family:
+            at = bisect_right(self._family_keys, key)
+            self._family_keys.insert(at, key)
+            self._family_hits.insert(at, tuple(hit))
+
+    def _city_filter(self, city):
+        city_lower = city.lower() if city else None
+        return lambda rid: city_lower is None or self._cities[rid].startswith(city_lower)
+
+    def search(self, name, city=None):
+        # Exact prefix hits if there are any, otherwise the closest fuzzy ones
+        return self.prefix_match(name, city) or self.fuzzy_match(name, city)
+
+    def prefix_match(self, name, city=None):
+        name_lower = name.lower()
+        in_city = self._city_filter(city)
+
+        lo, hi = _prefix_range(self._direct_keys, name_lower)
+        direct = {rid for rid in self._direct_ids[lo:hi] if in_city(rid)}
+
+        # Only the first matching family line per row counts, as before
+        family = {}
+        lo, hi = _prefix_range(self._family_keys, name_lower)
+        for rid, pos, line in self._family_hits[lo:hi]:
+            if rid in direct or not in_city(rid):
+                continue
+            if rid not in family or pos < family[rid][0]:
+                family[rid] = (pos, line)
+
+        # Ordered by the raw first name; ties put direct hits first, then sheet order
+        ranked = [(self._sort_names[rid], 0, rid, None) for rid in direct]
+        ranked += [(self._sort_names[rid], 1, rid, hit[1]) for rid, hit in family.items()]
+        ranked.sort()
+
+        return [
+            {'rid': rid, 'row': self.rows[rid], 'via_family': line is not None, 'matched_family': line}
+            for _, _, rid, line in ranked
+        ]
+
+    def fuzzy_match(self, name, city=None, limit=10, min_score=75, candidates=200):
+        # Typo fallback, ranked by score. Each key is also scored on just its
+        # first len(query) characters so a misspelt prefix ("kunjn") still
+        # finds longer names ("Kunjan").
+        query = name.lower().strip()
+        if len(query) < 2:
+            return []
+        best = {}
+        entries = self._fuzzy.entries
+        for eid in self._fuzzy.candidates(query, self._city_filter(city), candidates):
+            key, rid, line = entries[eid]
+            score = max(fuzz.ratio(query, key), fuzz.ratio(query, key[:len(query)]))
+            if score < min_score:
+                continue
+            # Prefer the higher score, then a direct hit over a family line
+            if rid not in best or (score, line is None) > (best[rid][0], best[rid][1] is None):
+                best[rid] = (score, line)
+
+        ranked = sorted(
+            best.items(),
+            key=lambda item: (-item[1][0], self._sort_names[item[0]], item[1][1] is not None, item[0])
+        )[:limit]
+        return [
+            {'rid': rid, 'row': self.rows[rid], 'via_family': line is not None, 'matched_family': line, 'score': score}
+            for rid, (score, line) in ranked
+        ]
+
+
+# === Bag Index ===
+# Normalized bag number -> rows carrying it. Bag numbers should be unique, so
+# any key with more than one row is collected in `duplicates` at build time.
+class BagIndex:
+    def __init__(self, rows):
+        self._by_bag = {}
+        self.duplicates = {}
+        for row in rows:
+            self.add(row)
+
+    def add(self, row):
+        key = row.bag_no.lower()
+        if key:
+            matches = self._by_bag.setdefault(key, [])
+            matches.append(row)
+            if len(matches) > 1:
+                self.duplicates[key] = matches
+
+    def lookup(self, bag_number):
+        return self._by_bag.get(bag_number.strip().lower(), [])
+
+
+# === Query Cache ===
+# LRU of rendered lookups keyed on the normalized query. Entries are only
+# valid for the snapshot version they were computed against; the first
+# lookup after a refresh or pickup write has bumped the version drops them
+# all.
+class QueryCache:
+    def __init__(self, max_entries=512):
+        self.max_entries = max_entries
+        self.version = None
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, version):
+        if version != self.version:
+            self._entries.clear()
+            self.version = version
+        value = self._entries.get(key)
+        if value is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key, version, value):
+        if version != self.version:
+            return
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+        if len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
@@ -0,0 +1,46 @@
+import os
+import secrets
+from urllib.parse import urlparse
+
+from telegram.ext import ApplicationBuilder
+
+# === Serving config ===
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")  # public https URL Telegram posts to; unset = polling
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8443"))
+# Telegram echoes this in X-Telegram-Bot-Api-Secret-Token on every call and
+# PTB rejects requests without it. A random one is fine: it is registered with
+# setWebhook on every start.
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or secrets.token_urlsafe(32)
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL")  # e.g. a local fake Bot API for testing
+
+
+def application_builder(token):
+    builder = ApplicationBuilder().token(token)
+    if TELEGRAM_API_URL:
+        base = TELEGRAM_API_URL.rstrip("/")
+        builder = builder.base_url(f"{base}/bot").base_file_url(f"{base}/file/bot")
+    return builder
+
+
+def run(app):
+    # Webhook when WEBHOOK_URL is set and the webhooks extra (tornado) is
+    # installed: Telegram pushes each update to us, so there is no long-poll
+    # round trip per message and no getUpdates loop while the tables are
+    # quiet. Anything else polls, which also deletes a stale webhook first.
+    if WEBHOOK_URL:
+        try:
+            import tornado  # noqa: F401 -- python-telegram-bot[webhooks]
+        except ImportError:
+            print("⚠️ WEBHOOK_URL is set but python-telegram-bot[webhooks] is not installed; polling instead.")
+        else:
+            print(f"🌐 Serving webhook on {WEBHOOK_LISTEN}:{WEBHOOK_PORT} for {WEBHOOK_URL}")
+            app.run_webhook(
+                listen=WEBHOOK_LISTEN,
+                port=WEBHOOK_PORT,
+                url_path=urlparse(WEBHOOK_URL).path.lstrip("/"),
+                webhook_url=WEBHOOK_URL,
+                secret_token=WEBHOOK_SECRET,
+            )
+            return
+    app.run_polling()
@@ -0,0 +1,166 @@
+import asyncio
+import heapq
+import itertools
+import time
+from collections import OrderedDict
+
+
+# === Session ===
+# A pending "reply with a number" prompt. Matches are kept as row ids into
+# the snapshot they were found in (plus the matched family line, if any)
+# rather than copies of the rows.
+class Session:
+    __slots__ = ('chat_id', 'kind', 'snapshot', 'rids', 'family', 'is_remove', 'fuzzy', 'expires_at', 'seq', 'message_id', 'page')
+
+    def __init__(self, chat_id, kind, snapshot, matches, is_remove, expires_at, seq):
+        self.chat_id = chat_id
+        self.kind = kind  # "choice", "pickup" or "checkin"
+        self.snapshot = snapshot
+        self.rids = tuple(m['rid'] for m in matches)
+        self.family = tuple(m['matched_family'] for m in matches)
+        self.is_remove = is_remove
+        self.fuzzy = bool(matches) and 'score' in matches[0]  # rendered under the "closest names" header
+        self.expires_at = expires_at
+        self.seq = seq
+        self.message_id = None  # the list message carrying inline buttons, once sent
+        self.page = 0           # page of that list currently shown
+
+    def __len__(self):
+        return len(self.rids)
+
+    def rebase(self, snapshot):
+        # Point the session at `snapshot` (the current one) so saving it
+        # doesn't drag along a second copy of the rows. False when one of its
+        # rows can't be found there unambiguously.
+        if snapshot is self.snapshot:
+            return True
+        rids = []
+        for rid in self.rids:
+            sheet_row = snapshot.locator.locate(self.snapshot.rows[rid])
+            if sheet_row is None:
+                return False
+            rids.append(sheet_row - 2)
+        self.snapshot, self.rids = snapshot, tuple(rids)
+        return True
+
+    def entry(self, idx):
+        line = self.family[idx]
+        return {'row': self.snapshot.rows[self.rids[idx]], 'via_family': line is not None, 'matched_family': line}
+
+
+# === Session Manager ===
+# One sweeper task walks a min-heap of expiry times instead of one sleeping
+# task per prompt. Sessions live in an LRU capped at `max_sessions`; opening
+# one past the cap silently drops the least recently used.
+class SessionManager:
+    def __init__(self, ttl=30, max_sessions=1000, on_expire=None):
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        self._on_expire = on_expire  # async fn(session)
+        self._sessions = OrderedDict()
+        self._deadlines = []  # (expires_at, seq, chat_id)
+        self._seq = itertools.count()
+        self._wakeup = asyncio.Event()
+        self._sweeper = None
+        self.opened = 0
+        self.expired = 0
+        self.evicted = 0
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def open(self, chat_id, kind, snapshot, matches, is_remove=False):
+        session = Session(chat_id, kind, snapshot, matches, is_remove, time.time() + self.ttl, next(self._seq))
+        self._sessions.pop(chat_id, None)
+        self._sessions[chat_id] = session
+        while len(self._sessions) > self.max_sessions:
+            self._sessions.popitem(last=False)
+            self.evicted += 1
+        heapq.heappush(self._deadlines, (session.expires_at, session.seq, chat_id))
+        self._wakeup.set()
+        self.opened += 1
+        return session
+
+    def get(self, chat_id):
+        session = self._sessions.get(chat_id)
+        if session is None:
+            return None
+        if session.expires_at <= time.time():
+            # The sweeper will report it; just don't act on it any more
+            return None
+        self._sessions.move_to_end(chat_id)
+        return session
+
+    def touch(self, session):
+        # The prompt is still in use (e.g. paging through its list); give it a
+        # full TTL again. Its earlier heap entry is skipped when it comes up.
+        session.expires_at = time.time() + self.ttl
+        heapq.heappush(self._deadlines, (session.expires_at, session.seq, session.chat_id))
+
+    def close(self, chat_id):
+        self._sessions.pop(chat_id, None)
+
+    def export(self, snapshot):
+        # Live sessions, oldest first, for the warm-start cache. All of them
+        # are moved onto `snapshot`, so it is the only one saved; a session
+        # that can't be moved is left out.
+        now = time.time()
+        return [s for s in self._sessions.values() if s.expires_at > now and s.rebase(snapshot)]
+
+    def restore(self, saved):
+        # Re-arm sessions saved by a previous process; expired ones are dropped.
+        # Each keeps its seq, since inline buttons already sent carry it, and
+        # new sessions are numbered after the highest one restored.
+        now = time.time()
+        last = -1
+        for session in saved:
+            if session.expires_at <= now:
+                continue
+            last = max(last, session.seq)
+            self._sessions[session.chat_id] = session
+            heapq.heappush(self._deadlines, (session.expires_at, session.seq, session.chat_id))
+        self._seq = itertools.count(max(last + 1, next(self._seq)))
+        while len(self._sessions) > self.max_sessions:
+            self._sessions.popitem(last=False)
+        self._wakeup.set()
+
+    def start(self):
+        if self._sweeper is None or self._sweeper.done():
+            self._sweeper = asyncio.create_task(self._sweep())
+        return self._sweeper
+
+    async def stop(self):
+        if self._sweeper is not None:
+            self._sweeper.cancel()
+            try:
+                await self._sweeper
+            except asyncio.CancelledError:
+                pass
+            self._sweeper = None
+
+    async def _sweep(self):
+        while True:
+            if not self._deadlines:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            expires_at, seq, chat_id = self._deadlines[0]
+            delay = expires_at - time.time()
+            if delay > 0:
+                # TTL is fixed, so later opens and touches never move the head earlier
+                await asyncio.sleep(delay)
+                continue
+            heapq.heappop(self._deadlines)
+            session = self._sessions.get(chat_id)
+            # Only the timer belonging to the live session may end it; a newer
+            # prompt in the same chat, or a touch, has its own entry further
+            # down the heap.
+            if session is None or session.seq != seq or session.expires_at > expires_at:
+                continue
+            del self._sessions[chat_id]
+            self.expired += 1
+            if self._on_expire:
+                try:
+                    await self._on_expire(session)
+                except Exception as e:
+                    print(f"❌ Could not send timeout to {chat_id}: {e}")
@@ -0,0 +1,129 @@
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+def column_letter(index):
+    # 1 -> A, 26 -> Z, 27 -> AA, 703 -> AAA
+    letters = ""
+    while index > 0:
+        index, rem = divmod(index - 1, 26)
+        letters = chr(65 + rem) + letters
+    return letters
+
+
+# === Sheets Client ===
+# googleapiclient is synchronous and its httplib2 transport is not
+# thread-safe, so every call runs on a small dedicated thread pool and each
+# worker thread builds its own service object on first use. Coroutines only
+# ever await the pool, which keeps the bot's event loop free while a Sheets
+# round trip is in flight.
+class SheetsClient:
+    def __init__(self, service_factory, sheet_id, sheet_name, max_workers=4):
+        self.sheet_id = sheet_id
+        self.sheet_name = sheet_name
+        self._service_factory = service_factory
+        self._local = threading.local()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="sheets")
+
+    def a1(self, cells):
+        return f"'{self.sheet_name}'!{cells}"
+
+    def _service(self):
+        service = getattr(self._local, "service", None)
+        if service is None:
+            service = self._local.service = self._service_factory()
+        return service
+
+    async def _run(self, fn, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, fn, *args)
+
+    def _get_values(self, cells):
+        return self._service().spreadsheets().values().get(
+            spreadsheetId=self.sheet_id,
+            range=self.a1(cells)
+        ).execute().get("values", [])
+
+    def _batch_get(self, cells_list):
+        value_ranges = self._service().spreadsheets().values().batchGet(
+            spreadsheetId=self.sheet_id,
+            ranges=[self.a1(cells) for cells in cells_list]
+        ).execute().get("valueRanges", [])
+        return [vr.get("values", []) for vr in value_ranges]
+
+    def _dimensions(self):
+        # Actual grid size of the tab, so we never read past it or cut it short
+        sheets = self._service().spreadsheets().get(
+            spreadsheetId=self.sheet_id,
+            ranges=[self.a1("A1")],
+            fields="sheets(properties(gridProperties(rowCount,columnCount)))"
+        ).execute().get("sheets", [])
+        grid = sheets[0]["properties"]["gridProperties"] if sheets else {}
+        return grid.get("rowCount", 0), grid.get("columnCount", 0)
+
+    def _page_ranges(self, rows, cols, page_rows):
+        last_col = column_letter(cols)
+        for start in range(1, rows + 1, page_rows):
+            end = min(start + page_rows - 1, rows)
+            yield f"A{start}:{last_col}{end}", end - start + 1
+
+    def iter_pages(self, page_rows=500):
+        # Synchronous paged read of the whole tab, header row included. The API
+        # drops trailing empty rows of each page, so a short page is padded
+        # back out only if a later page still has data; rows keep their
+        # sheet positions and the final page stays trimmed.
+        rows, cols = self._dimensions()
+        gap = 0
+        for cells, size in self._page_ranges(rows, cols, page_rows):
+            page = self._get_values(cells)
+            if not page:
+                gap += size
+                continue
+            if gap:
+                yield [[] for _ in range(gap)]
+            yield page
+            gap = size - len(page)
+
+    async def pages(self, page_rows=500):
+        # Async counterpart of iter_pages. The next page is requested before
+        # the current one is handed over, so the caller parses one page while
+        # the following round trip is in flight.
+        rows, cols = await self._run(self._dimensions)
+        ranges = list(self._page_ranges(rows, cols, page_rows))
+        pending = self._run(self._get_values, ranges[0][0]) if ranges else None
+        gap = 0
+        for i, (_, size) in enumerate(ranges):
+            page = await pending
+            if i + 1 < len(ranges):
+                pending = asyncio.ensure_future(self._run(self._get_values, ranges[i + 1][0]))
+            if not page:
+                gap += size
+                continue
+            if gap:
+                yield [[] for _ in range(gap)]
+            yield page
+            gap = size - len(page)
+
+    def _batch_update(self, updates):
+        return self._service().spreadsheets().values().batchUpdate(
+            spreadsheetId=self.sheet_id,
+            body={
+                "valueInputOption": "RAW",
+                "data": [{"range": self.a1(cells), "values": values} for cells, values in updates]
+            }
+        ).execute()
+
+    async def get_values(self, cells):
+        return await self._run(self._get_values, cells)
+
+    async def batch_get(self, cells_list):
+        return await self._run(self._batch_get, cells_list)
+
+    async def batch_update(self, updates):
+        # updates: list of (cells, 2-D values) pairs
+        return await self._run(self._batch_update, updates)
+
+    def close(self, wait=True):
+        # wait=False at shutdown, so a hung request can't hold up the exit
+        self._executor.shutdown(wait=wait, cancel_futures=not wait)
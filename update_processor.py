@@ -0,0 +1,44 @@
+import asyncio
+
+from telegram.ext import BaseUpdateProcessor
+
+
+# === Per-chat ordered update processing ===
+# Updates from different chats run concurrently (up to
+# `max_concurrent_updates`), while updates from the same chat run one at a
+# time in arrival order. PTB starts one task per update in the order they were
+# fetched, takes a concurrency slot and then calls do_process_update, which
+# waits on the chat's lock; asyncio.Lock wakes waiters first-come first-served,
+# so a number reply is always handled after the `b`/`p`/`u` prompt that chat
+# sent before it. process_update itself is final in PTB, so an update waiting
+# on its chat does hold a slot meanwhile.
+class ChatOrderedUpdateProcessor(BaseUpdateProcessor):
+    __slots__ = ("_chats",)
+
+    def __init__(self, max_concurrent_updates=64):
+        super().__init__(max_concurrent_updates)
+        self._chats = {}  # chat_id -> [lock, tasks holding or waiting on it]
+
+    def __len__(self):
+        return len(self._chats)
+
+    async def do_process_update(self, update, coroutine):
+        chat = getattr(update, "effective_chat", None)
+        if chat is None:
+            await coroutine
+            return
+        entry = self._chats.setdefault(chat.id, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                await coroutine
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._chats[chat.id]
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
@@ -4,12 +4,23 @@ import time
 import base64
 import asyncio
 from dotenv import load_dotenv
-from telegram import Update
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Update
+from telegram.error import BadRequest
 from decrypt_utils import decrypt_and_load_json
+from registration_store import KEY_COLUMNS, RegistrationStore, rows_from_values
+from write_queue import PickupWriteQueue
+from sheets_client import SheetsClient, column_letter
+from search_index import QueryCache
+from sessions import SessionManager
+from warm_cache import WarmCache
+from inventory import ShirtInventory, parse_stock
+from update_processor import ChatOrderedUpdateProcessor
+from outbox import Outbox, PRIORITY_BULK, PRIORITY_CONFIRM, PRIORITY_REPLY
 from telegram.ext import (
-    ApplicationBuilder, ContextTypes,
-    CommandHandler, MessageHandler, filters
+    ContextTypes,
+    CallbackQueryHandler, CommandHandler, MessageHandler, filters
 )
+import serving
 import gspread
 import gnupg
 from google.oauth2 import service_account
@@ -22,6 +33,25 @@ SERVICE_ACCOUNT_JSON_RAW = os.getenv("GOOGLE_SERVICE_ACCOUNT_JSON")
 SHEET_ID = os.getenv("GOOGLE_SHEET_ID")
 SHEET_NAME = "01-01-2025 to 05-02-2025"
 GPG_PASSPHRASE = os.getenv("GPG_PASSPHRASE")
+SHEET_REFRESH_SECONDS = int(os.getenv("SHEET_REFRESH_SECONDS", "30"))
+SHEET_FRESHNESS_SECONDS = int(os.getenv("SHEET_FRESHNESS_SECONDS", "10"))
+SHEET_SYNC_MODE = os.getenv("SHEET_SYNC_MODE", "incremental")  # or "full"
+SHEET_FULL_SYNC_EVERY = int(os.getenv("SHEET_FULL_SYNC_EVERY", "20"))  # deltas between full reloads
+WRITE_BATCH_SECONDS = float(os.getenv("WRITE_BATCH_SECONDS", "1.5"))
+SHEETS_WORKERS = int(os.getenv("SHEETS_WORKERS", "4"))
+SHEET_PAGE_ROWS = int(os.getenv("SHEET_PAGE_ROWS", "500"))
+QUERY_CACHE_SIZE = int(os.getenv("QUERY_CACHE_SIZE", "512"))
+SESSION_TTL = int(os.getenv("SESSION_TTL", "30"))  # seconds
+MAX_SESSIONS = int(os.getenv("MAX_SESSIONS", "1000"))
+MATCH_PAGE_SIZE = int(os.getenv("MATCH_PAGE_SIZE", "10"))  # names per page of a match list
+WARM_CACHE_PATH = os.getenv("WARM_CACHE_PATH", ".cache/warm_start.gpg")  # empty disables it
+WARM_CACHE_SECONDS = int(os.getenv("WARM_CACHE_SECONDS", "60"))
+# GitHub Actions sends SIGINT on cancel and escalates to SIGKILL about 10s later
+SHUTDOWN_DEADLINE_SECONDS = float(os.getenv("SHUTDOWN_DEADLINE_SECONDS", "6"))
+SHIRT_STOCK = os.getenv("SHIRT_STOCK", "")  # starting stock, e.g. "SM=120,MD=200,LG=180"
+LOW_STOCK_THRESHOLD = int(os.getenv("LOW_STOCK_THRESHOLD", "10"))
+ADMIN_CHAT_ID = os.getenv("ADMIN_CHAT_ID")  # where low-stock alerts go
+CONCURRENT_UPDATES = int(os.getenv("CONCURRENT_UPDATES", "64"))  # across chats; each chat stays in order
 
 # === Google Sheets Setup ===
 print("kunj checking0 - " + SERVICE_ACCOUNT_JSON_RAW)
@@ -32,44 +62,45 @@ creds = service_account.Credentials.from_service_account_info(
     json.loads(SERVICE_ACCOUNT_JSON),
     scopes=["https://www.googleapis.com/auth/spreadsheets"]
 )
-sheets_service = build('sheets', 'v4', credentials=creds)
+# === Warm-start cache ===
+# Last snapshot's rows (indexes are rebuilt on load), open sessions and
+# pending writes from the previous run; see warm_cache.py
+if WARM_CACHE_PATH:
+    os.makedirs(os.path.dirname(WARM_CACHE_PATH) or ".", exist_ok=True)
+warm_cache = WarmCache(WARM_CACHE_PATH, GPG_PASSPHRASE)
+warm_state = warm_cache.load() or {}
+
+# One service per worker thread; see sheets_client.py. build() reads the
+# discovery document bundled with googleapiclient, so this is offline.
+sheets = SheetsClient(
+    lambda: build('sheets', 'v4', credentials=creds),
+    SHEET_ID, SHEET_NAME, max_workers=SHEETS_WORKERS
+)
 
 # === Load decrypted registration data ===
-initial_data = decrypt_and_load_json(GPG_PASSPHRASE)
+# Only used until the first sheet refresh lands (cold start / Sheets outage),
+# and skipped entirely when the warm-start cache has a snapshot.
+initial_data = None if 'snapshot' in warm_state else decrypt_and_load_json(GPG_PASSPHRASE)
 
-async def get_current_data():
-    # Always pull the latest from Google Sheet if possible
-    fresh_data = await fetch_latest_data()
-    return fresh_data if fresh_data else initial_data
+def get_current_data():
+    # Served from the in-memory snapshot without waiting. A snapshot older than
+    # SHEET_FRESHNESS_SECONDS kicks off one shared background refresh.
+    return store.refresh_soon()
 
 # === Globals ===
-user_state = {}  # chat_id -> dict(state)
-SESSION_TTL = 30  # seconds
 MAX_MSG_LENGTH = 4000  # Telegram safe limit
-
-def extract_shirt_info(row):
-    sizes = ["SM", "MD", "LG", "XL", "XXL", "Y-LG", "Y-MD", "Y-SM", "Y-XS"]
-    shirt_counts = {}
-    for size in sizes:
-        count = row.get(size)
-        try:
-            count = int(count) if count is not None else 0
-        except ValueError:
-            count = 0
-        if count > 0:
-            shirt_counts[size] = count
-    return shirt_counts
+MAX_BULK_BAGS = int(os.getenv("MAX_BULK_BAGS", "50"))  # bags per `p 101 102 115-120` message
 
 def format_entry(entry):
     row = entry['row']
-    full_name = f"{row.get('Registrant First Name', '')} {row.get('Registrant Last Name', '')}"
-    attendees = row.get('Attendees', '?')
-    city = row.get('City', 'Unknown')
-    family = row.get('Additional Family Members', 'None').strip()
-    bag_no = row.get('Bag No.', 'N/A')
-    shirts = extract_shirt_info(row)
-    total_shirts = sum(shirts.values())
-    pickup = row.get('Pickup', '').strip().lower()
+    full_name = row.full_name
+    attendees = row.attendees if row.attendees is not None else '?'
+    city = row.city or 'Unknown'
+    family = "\n".join(row.family)
+    bag_no = row.bag_no or 'N/A'
+    shirts = row.shirts
+    total_shirts = row.total_shirts
+    pickup = row.pickup_state
 
     response = f"""✅ *{full_name}* is registered.
 📍 *City:* {city}
@@ -79,7 +110,7 @@ def format_entry(entry):
 
     if shirts:
         response += "\n\n👕 *T-Shirts Ordered:*\n"
-        for size, count in shirts.items():
+        for size, count in shirts:
             response += f"- {size}: {count}\n"
         response += f"\n📦 *Total T-Shirts:* {total_shirts}"
     else:
@@ -97,100 +128,361 @@ def format_entry(entry):
 
     return response
 
-def prefix_match(name, city, data):
-    name_lower = name.lower()
-    direct = []
-    family = []
+async def fetch_latest_data():
+    # Full load: discover the tab's real size and read it in SHEET_PAGE_ROWS
+    # pages, turning each page into row dicts as it arrives
+    try:
+        headers, rows = None, []
+        async for page in sheets.pages(SHEET_PAGE_ROWS):
+            if headers is None:
+                headers, page = page[0], page[1:]
+            rows.extend(rows_from_values(headers, page))
+        return (headers, rows) if headers else None
+    except Exception as e:
+        print(f"❌ Failed to fetch live sheet: {e}")
+        return None
+
+async def fetch_pickup_delta(snapshot):
+    # Incremental sync: only the Pickup column plus the first-name column (to
+    # spot appended or reordered rows), and full rows only for the new tail.
+    columns = snapshot.locator.columns
+    pickup = column_letter(columns['Pickup'])
+    first = column_letter(columns['Registrant First Name'])
+    pickup_cells, name_cells = await sheets.batch_get([f"{pickup}2:{pickup}", f"{first}2:{first}"])
+    appended = []
+    if len(name_cells) > len(snapshot.rows):
+        appended = await sheets.get_values(
+            f"A{len(snapshot.rows) + 2}:{column_letter(len(snapshot.headers))}{len(name_cells) + 1}"
+        )
+        # The read trims trailing empty rows; keep one entry per appended row
+        appended += [[]] * (len(name_cells) - len(snapshot.rows) - len(appended))
+    return (
+        [cells[0] if cells else '' for cells in pickup_cells],
+        [cells[0] if cells else '' for cells in name_cells],
+        appended,
+    )
 
-    for row in data:
-        r_city = row.get('City', '').lower()
-        r_fname = row.get('Registrant First Name', '').lower()
-        r_lname = row.get('Registrant Last Name', '').lower()
-        full_name = f"{r_fname} {r_lname}"
+def key_range(snapshot, sheet_row):
+    first, last = snapshot.locator.key_span()
+    return f"{column_letter(first)}{sheet_row}:{column_letter(last)}{sheet_row}"
+
+async def locate_writes(snapshot, writes):
+    # Resolve each write to its sheet cell and re-read the key cells of every
+    # target row in one batchGet, so rows moved since the last refresh are
+    # caught before we write into the wrong registration.
+    located = []
+    for write in writes:
+        sheet_row = snapshot.locator.locate(write.row)
+        col_index = snapshot.locator.columns.get(write.column)
+        if sheet_row is not None and col_index is not None:
+            located.append((write, sheet_row, col_index))
+    if not located or snapshot.locator.key_span() is None:
+        return [], writes
+
+    ranges = [key_range(snapshot, sheet_row) for _, sheet_row, _ in located]
+    live = await sheets.batch_get(ranges)
+
+    first, last = snapshot.locator.key_span()
+    key_headers = snapshot.headers[first - 1:last]
+    verified = []
+    for (write, sheet_row, col_index), cells in zip(located, live):
+        live = dict(zip(key_headers, cells[0] if cells else []))
+        if tuple(live.get(col, '') for col in KEY_COLUMNS) == write.row.key:
+            verified.append((write, sheet_row, col_index))
+    verified_writes = {id(w) for w, _, _ in verified}
+    return verified, [w for w in writes if id(w) not in verified_writes]
+
+async def write_pickups(writes):
+    verified, unresolved = await locate_writes(store.snapshot, writes)
+    if unresolved:
+        # Sheet was edited since the last refresh; re-read once and retry
+        store.request_full_sync()
+        retried, unresolved = await locate_writes(await store.refresh(), unresolved)
+        verified += retried
+    if verified:
+        await sheets.batch_update([
+            (f"{column_letter(col_index)}{sheet_row}", [[write.value]])
+            for write, sheet_row, col_index in verified
+        ])
+        # A refresh during the retry above may have loaded pre-write values
+        for write, _, _ in verified:
+            store.patch_pickup(write.row, write.value)
+    for write in unresolved:
+        print(f"❌ Could not locate {write.row.key} in the sheet")
+    return unresolved
+
+async def report_failed_writes(chat_id, writes):
+    names = ", ".join(w.row.first_name for w in writes)
+    await outbox.send(
+        chat_id,
+        f"⚠️ Could not save the pickup change for *{names}* to the sheet. Please try again.",
+        parse_mode='Markdown'
+    )
 
-        if city and not r_city.startswith(city.lower()):
-            continue
+store = RegistrationStore(
+    fetch_latest_data, initial_data,
+    freshness=SHEET_FRESHNESS_SECONDS,
+    fetch_delta=fetch_pickup_delta if SHEET_SYNC_MODE == "incremental" else None,
+    full_sync_every=SHEET_FULL_SYNC_EVERY,
+    snapshot=warm_state.pop('snapshot', None),
+)
+query_cache = QueryCache(QUERY_CACHE_SIZE)
+pickup_writes = PickupWriteQueue(store, write_pickups, report_failed_writes, WRITE_BATCH_SECONDS)
 
-        if (
-            r_fname.startswith(name_lower)
-            or r_lname.startswith(name_lower)
-            or full_name.startswith(name_lower)
-        ):
-            direct.append({'row': row, 'via_family': False, 'matched_family': None})
-            continue
+async def clear_keyboard(session):
+    # Take the buttons off a list that can no longer be used
+    if session.message_id is None:
+        return
+    try:
+        await outbox.edit(session.chat_id, session.message_id, reply_markup=None)
+    except Exception as e:
+        print(f"⚠️ Could not clear the keyboard in {session.chat_id}: {e}")
 
-        for line in row.get('Additional Family Members', '').split('\n'):
-            if line.strip().lower().startswith(name_lower):
-                family.append({'row': row, 'via_family': True, 'matched_family': line.strip()})
-                break
+async def send_timeout(session):
+    await clear_keyboard(session)
+    await outbox.send(session.chat_id, "⏳ Timeout. Send a new query.")
 
-    return sorted(direct + family, key=lambda x: x['row'].get('Registrant First Name', ''))
+sessions = SessionManager(SESSION_TTL, MAX_SESSIONS, send_timeout)
+sessions.restore(warm_state.pop('sessions', []))
 
-async def fetch_latest_data():
-    try:
-        range_name = f"'{SHEET_NAME}'!A1:Z1000"
-        result = sheets_service.spreadsheets().values().get(
-            spreadsheetId=SHEET_ID,
-            range=range_name
-        ).execute()
-        values = result.get("values", [])
-        headers = values[0]
-        return [dict(zip(headers, row)) for row in values[1:]]
-    except Exception as e:
-        print(f"❌ Failed to fetch live sheet: {e}")
-        return []
+def warm_state_now():
+    return {
+        'snapshot': store.snapshot,
+        'sessions': sessions.export(store.snapshot),
+        'writes': pickup_writes.export(),
+    }
 
-def update_sheet_column(row, column_name, value):
+inventory = ShirtInventory(parse_stock(SHIRT_STOCK), LOW_STOCK_THRESHOLD)
+
+async def alert_low_stock():
+    low = inventory.newly_low(store.snapshot.tally)
+    if not low or not ADMIN_CHAT_ID:
+        return
+    lines = [f"- {size}: *{left}* left, {owed} still owed" for size, _, _, left, owed in low]
     try:
-        all_data = sheets_service.spreadsheets().values().get(
-            spreadsheetId=SHEET_ID,
-            range=f"'{SHEET_NAME}'!A1:Z1000"
-        ).execute().get("values", [])
-
-        headers = all_data[0]
-        for idx, r in enumerate(all_data[1:], start=2):
-            record = dict(zip(headers, r))
-            if (
-                record.get('Registrant First Name') == row.get('Registrant First Name')
-                and record.get('Registrant Last Name') == row.get('Registrant Last Name')
-                and record.get('City') == row.get('City')
-            ):
-                col_index = headers.index(column_name) + 1
-                sheets_service.spreadsheets().values().update(
-                    spreadsheetId=SHEET_ID,
-                    range=f"'{SHEET_NAME}'!{chr(64 + col_index)}{idx}",
-                    valueInputOption="RAW",
-                    body={"values": [[value]]}
-                ).execute()
-                return True
+        await outbox.send(
+            ADMIN_CHAT_ID, "⚠️ *Low T-shirt stock*\n\n" + "\n".join(lines), parse_mode='Markdown'
+        )
     except Exception as e:
-        print(f"❌ Error updating sheet: {e}")
-    return False
+        print(f"❌ Could not send low-stock alert: {e}")
 
-def bag_match(bag_number, data):
-    return [ {'row': row, 'via_family': False, 'matched_family': None}
-             for row in data if row.get('Bag No.', '').strip().lower() == bag_number.lower() ]
+def check_stock():
+    # After every pickup change or refresh; the check is a few tally reads
+    asyncio.ensure_future(alert_low_stock())
 
+store.add_listener(lambda snapshot: check_stock())
 
-async def send_split_message(text, update):
-    lines = text.strip().split('\n')
-    chunks = []
-    current = ""
+def set_pickup(row, value, chat_id=None):
+    # Applied to the snapshot now, written to the sheet with the next batch
+    pickup_writes.enqueue(row, value, chat_id)
+    check_stock()
 
-    for line in lines:
-        if len(current) + len(line) + 1 < MAX_MSG_LENGTH:
-            current += line + "\n"
+def bag_match(bag_number, snapshot):
+    return [ {'row': row, 'via_family': False, 'matched_family': None}
+             for row in snapshot.bags.lookup(bag_number) ]
+
+def parse_bag_list(spec):
+    # "101 102, 115-120" -> ["101", "102", "115", ..., "120"]; None unless
+    # every part is a bag number or an ascending range of them
+    bags = []
+    for part in spec.replace(",", " ").split():
+        part = part.rstrip(".")
+        start, dash, end = part.partition("-")
+        if not start.isdigit() or (dash and not end.isdigit()):
+            return None
+        if not dash:
+            bags.append(start)
+            continue
+        if int(end) < int(start):
+            return None
+        # An oversized range only needs to be long enough for mark_bags to refuse
+        end = min(int(end), int(start) + MAX_BULK_BAGS)
+        # Keep zero padding ("007-010"), as the sheet's bag numbers may have it
+        width = len(start) if start.startswith("0") else 0
+        bags.extend(str(n).zfill(width) for n in range(int(start), int(end) + 1))
+    return list(dict.fromkeys(bags)) or None
+
+def resolve_bags(bags, snapshot):
+    # Every bag is checked before anything is marked: (rows by bag, unknown
+    # bags, bags shared by several registrations)
+    found, unknown, shared = {}, [], []
+    for bag_number in bags:
+        rows = snapshot.bags.lookup(bag_number)
+        if not rows:
+            unknown.append(bag_number)
+        elif len(rows) > 1:
+            shared.append(bag_number)
+        else:
+            found[bag_number] = rows[0]
+    return found, unknown, shared
+
+def is_fuzzy(matches):
+    return bool(matches) and 'score' in matches[0]
+
+def match_list_header(total, fuzzy):
+    if fuzzy:
+        return f"🤔 *No exact match. Closest {total} names:*\n\n"
+    return f"🔎 *Found {total} possible matches:*\n\n"
+
+def page_count(total):
+    return max(1, -(-total // MATCH_PAGE_SIZE))
+
+def render_match_page(command, entries, page, total, fuzzy):
+    # One page of the numbered list; `entries` are the matches on that page
+    kind, is_remove = command[0], command.endswith("remove")
+    reply = match_list_header(total, fuzzy)
+    for i, m in enumerate(entries, page * MATCH_PAGE_SIZE + 1):
+        r = m['row']
+        full = r.full_name
+        city_name = r.city or '?'
+        note = f" _(via family: {m['matched_family']})_" if m['via_family'] else ""
+        if kind == "b":
+            attendees = r.attendees if r.attendees is not None else '?'
+            reply += f"{i}. *{full}* — {attendees} attendees – {city_name}{note}\n"
+        elif kind == "p":
+            reply += f"{i}. *{full}* – {city_name}{note}\n"
         else:
-            chunks.append(current.strip())
-            current = line + "\n"
-    if current:
-        chunks.append(current.strip())
+            reply += f"{i}. *{full}* — {city_name}{note}\n"
+
+    if page_count(total) > 1:
+        reply += f"\n📄 Page {page + 1} of {page_count(total)}"
+    if kind == "b":
+        reply += "\n✉️ *Tap a number (or reply with it) to see full details.*"
+    elif kind == "p":
+        reply += f"\n✉️ Tap a number (or reply with it) to {'remove' if is_remove else 'mark'} pickup."
+    else:
+        reply += "\n✉️ Tap a number (or reply with it) to mark as *Checked In (No Pickup)*."
+    return reply
+
+def render_matches(command, matches):
+    # The reply for a name lookup: the entry itself for a single `b` hit,
+    # None for a single exact `p`/`u` hit (applied directly), else the first
+    # page of the numbered list to pick from
+    kind = command[0]
+    if kind == "b" and len(matches) == 1:
+        return format_entry(matches[0])
+    if kind != "b" and len(matches) == 1 and not is_fuzzy(matches):
+        return None
+    return render_match_page(command, matches[:MATCH_PAGE_SIZE], 0, len(matches), is_fuzzy(matches))
+
+SESSION_COMMANDS = {'choice': "b", 'pickup': "p", 'checkin': "u"}
+
+def render_session_page(session, page):
+    # Later pages are rendered from the session's row ids, not a new search
+    command = SESSION_COMMANDS[session.kind] + (" remove" if session.is_remove else "")
+    start = page * MATCH_PAGE_SIZE
+    entries = [session.entry(i) for i in range(start, min(start + MATCH_PAGE_SIZE, len(session)))]
+    return render_match_page(command, entries, page, len(session), session.fuzzy)
+
+def match_keyboard(session, page):
+    # Number buttons for the page plus prev/next. Callback data carries the
+    # session's seq, so buttons on an old list can't act on a newer one.
+    start = page * MATCH_PAGE_SIZE
+    numbers = [
+        InlineKeyboardButton(str(i + 1), callback_data=f"pick:{session.seq}:{i}")
+        for i in range(start, min(start + MATCH_PAGE_SIZE, len(session)))
+    ]
+    rows = [numbers[i:i + 5] for i in range(0, len(numbers), 5)]
+    nav = []
+    if page > 0:
+        nav.append(InlineKeyboardButton("◀️ Prev", callback_data=f"page:{session.seq}:{page - 1}"))
+    if page + 1 < page_count(len(session)):
+        nav.append(InlineKeyboardButton("Next ▶️", callback_data=f"page:{session.seq}:{page + 1}"))
+    if nav:
+        rows.append(nav)
+    return InlineKeyboardMarkup(rows)
+
+def apply_choice(session, idx, chat_id):
+    # Acts on pick `idx` of a session; returns the reply text and its priority
+    entry = session.entry(idx)
+    if session.kind == 'choice':
+        return format_entry(entry), PRIORITY_REPLY
+    row = entry['row']
+    if session.kind == 'pickup':
+        value = "" if session.is_remove else "Yes"
+        status = "removed from pickup" if session.is_remove else "marked as picked up"
+    else:
+        value = "" if session.is_remove else "No"
+        status = "removed from pickup" if session.is_remove else "marked as Checked In (No Pickup)"
+    set_pickup(row, value, chat_id)
+    return f"✅ *{row.first_name}* {status}. For Bag No: *{row.bag_no or 'N/A'}*.", PRIORITY_CONFIRM
+
+async def send_match_list(update, chat_id, kind, snapshot, matches, reply, is_remove=False):
+    # Opens the session first so the keyboard can carry its seq
+    previous = sessions.get(chat_id)
+    session = sessions.open(chat_id, kind, snapshot, matches, is_remove)
+    message = await send_reply(update, reply, parse_mode='Markdown', reply_markup=match_keyboard(session, 0))
+    session.message_id = message.message_id
+    if previous is not None:
+        await clear_keyboard(previous)
+
+def find_matches(command, name, city, snapshot):
+    # Same families get looked up over and over at the tables; reuse the
+    # match list and rendered reply until the snapshot version moves on
+    key = (command, " ".join(name.lower().split()), (city or "").lower())
+    cached = query_cache.get(key, snapshot.version)
+    if cached is None:
+        matches = snapshot.names.search(name, city)
+        cached = (matches, render_matches(command, matches) if matches else None)
+        query_cache.put(key, snapshot.version, cached)
+    return cached
+
+async def mark_bags(update, chat_id, kind, bags, is_remove=False):
+    if len(bags) > MAX_BULK_BAGS:
+        await send_reply(update, f"❗ Up to {MAX_BULK_BAGS} bags per message, please.")
+        return
+    found, unknown, shared = resolve_bags(bags, get_current_data())
+    if kind == "p":
+        value = "" if is_remove else "Yes"
+        status = "removed from pickup" if is_remove else "marked as picked up"
+    else:
+        value = "" if is_remove else "No"
+        status = "removed from pickup" if is_remove else "marked as Checked In (No Pickup)"
+
+    # Enqueued together, so they go out in the same batchUpdate
+    for row in found.values():
+        pickup_writes.enqueue(row, value, chat_id)
+    if found:
+        check_stock()
+
+    reply = f"✅ *{len(found)} of {len(bags)} bags* {status}:\n" if found else "❌ *No bags were changed.*\n"
+    for bag_number, row in found.items():
+        reply += f"- *{bag_number}* — {row.full_name}\n"
+    if unknown:
+        reply += f"\n❌ *Unknown bags:* {', '.join(unknown)}\n"
+    if shared:
+        reply += f"\n⚠️ *On several registrations, skipped:* {', '.join(shared)}\nPlease use the name for these.\n"
+    await send_reply(update, reply, PRIORITY_CONFIRM, parse_mode='Markdown')
+
+async def reply_duplicate_bag(update, bag_number, matches):
+    reply = f"⚠️ *Bag No. {bag_number}* is assigned to {len(matches)} registrations:\n\n"
+    for i, m in enumerate(matches, 1):
+        r = m['row']
+        full = r.full_name
+        reply += f"{i}. *{full}* — {r.city or '?'}\n"
+    reply += "\nNothing was changed. Please use the name instead and fix the bag number in the sheet."
+    await send_reply(update, reply, parse_mode='Markdown')
+
+
+def _reply_kwargs(update, kwargs):
+    # Quote the message in group chats, as reply_text does
+    if update.effective_chat.type != "private":
+        kwargs.setdefault("reply_to_message_id", update.effective_message.message_id)
+    return kwargs
+
+async def send_reply(update, text, priority=PRIORITY_REPLY, **kwargs):
+    # Every reply goes through the outbox (flood limits, priorities)
+    return await outbox.send(update.effective_chat.id, text, priority, **_reply_kwargs(update, kwargs))
 
-    for chunk in chunks:
-        await update.message.reply_text(chunk, parse_mode='Markdown')
+async def send_split_message(text, update):
+    return await outbox.send_split(
+        update.effective_chat.id, text, PRIORITY_BULK, MAX_MSG_LENGTH,
+        **_reply_kwargs(update, {"parse_mode": "Markdown"})
+    )
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await update.message.reply_text(
+    await send_reply(
+        update,
         "👋 Welcome! Use `b` to check registration, `p` to mark pickup, or `p remove` to undo.\nType `/help` or `/format` to view all supported formats."
     )
 
@@ -213,121 +505,151 @@ async def show_help(update: Update, context: ContextTypes.DEFAULT_TYPE):
 - `p LastName`
 - `p Kun add`
 - `p kunj\\naddison`
+- `p 101 102 115-120` *(several bag numbers at once)*
 
 🚫 *Undo Pickup* (`p remove ...`)
 - Same formats as above, just add `remove`
   - Example: `p remove Kunj Patel Addison`
+  - Bag numbers too: `p remove 101 102`
 """
-    await update.message.reply_text(help_text, parse_mode='Markdown')
+    await send_reply(update, help_text, parse_mode='Markdown')
 
 async def show_summary(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    data = await get_current_data()
-    picked_up = 0
-    not_picked_up = 0
+    # Read from the snapshot's running tally; no Sheets call and no pass over
+    # the rows. Background and handler refreshes keep it current.
+    snapshot = get_current_data()
+    tally = snapshot.tally
+    view = context.args[0].lower() if context.args else ""
+
+    if view == "city":
+        summary = "🏙️ *Pickup by City*\n\n"
+        for city, states in sorted(tally.cities.items()):
+            if sum(states.values()):
+                summary += f"*{city}*: ✅ {states['yes']}  ❌ {states['no']}  ⏳ {states['']}\n"
+        await send_split_message(summary, update)
+        return
 
-    for row in data:
-        pickup = row.get("Pickup", "").strip().lower()
-        if pickup == "yes":
-            picked_up += 1
-        elif pickup == "no":
-            not_picked_up += 1
+    if view == "shirts":
+        summary = "👕 *T-Shirts by Size*\n\n"
+        for size, owed in tally.shirts_owed():
+            summary += f"- {size}: {tally.shirts_given[size]} handed out, *{owed}* still owed\n"
+        await send_reply(update, summary, parse_mode='Markdown')
+        return
 
+    picked_up = tally.rows["yes"]
+    not_picked_up = tally.rows["no"]
     total = picked_up + not_picked_up
     pickup_percent = (picked_up / total) * 100 if total > 0 else 0
+    attendees_in = tally.attendees["yes"] + tally.attendees["no"]
+    attendees_all = sum(tally.attendees.values())
+    shirts_owed = sum(owed for _, owed in tally.shirts_owed())
 
     summary = f"""📊 *Pickup Summary*
 
 ✅ Picked Up: *{picked_up}*
 ❌ Not Picked Up: *{not_picked_up}*
 📦 Total Bags: *{total}*
+⏳ Not Checked In: *{tally.rows['']}*
 
 📈 *Completion:* *{pickup_percent:.2f}%*
+👥 Attendees Checked In: *{attendees_in}* of *{attendees_all}*
+👕 T-Shirts Still Owed: *{shirts_owed}*
+
+More: `/summary city`, `/summary shirts`
+"""
+    await send_reply(update, summary, parse_mode='Markdown')
+
+async def show_inventory(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    levels = inventory.levels(get_current_data().tally)
+    if not levels:
+        await send_reply(update, "👕 No T-shirts ordered or stocked.")
+        return
+    reply = "👕 *T-Shirt Inventory*\n\n"
+    for size, stock, given, left, owed in levels:
+        if stock is None:
+            reply += f"*{size}*: {given} handed out, {owed} still owed (no stock set)\n"
+            continue
+        short = f" ⚠️ *{owed - left} short*" if owed > left else ""
+        low = " 🔻" if left <= inventory.low_threshold else ""
+        reply += f"*{size}*: *{left}* of {stock} left{low}, {given} handed out, {owed} still owed{short}\n"
+    await send_reply(update, reply, parse_mode='Markdown')
+
+async def show_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    snapshot = store.snapshot
+    refresh = store.refresh_stats()
+    stats = f"""⚙️ *Bot Stats*
+
+🗂️ Snapshot: v{snapshot.version} ({snapshot.source}), {len(snapshot.rows)} rows, {snapshot.age():.0f}s old
+🔄 Refreshes: {refresh['misses']} fetched, {refresh['hits']} fresh hits, {refresh['joins']} joined in-flight
+💾 Fetches saved: *{refresh['saved_ratio'] * 100:.1f}%*
+🧠 Query cache: {len(query_cache)} entries, {query_cache.hits} hits / {query_cache.misses} misses (*{query_cache.hit_rate() * 100:.1f}%*)
+✍️ Pickup writes: {pickup_writes.enqueued} queued, {pickup_writes.sent} sent in {pickup_writes.flushes} batches, {len(pickup_writes)} pending
+💬 Sessions: {len(sessions)} open, {sessions.opened} opened, {sessions.expired} timed out, {sessions.evicted} evicted
+📤 Outbox: {outbox.sent} sent, {outbox.retried} retried after flood limits, {len(outbox)} queued
+🔀 Last handover gap: {f"{handover_gap:.1f}s" if handover_gap is not None else 'n/a'}
 """
-    await update.message.reply_text(summary, parse_mode='Markdown')
+    await send_reply(update, stats, parse_mode='Markdown')
 
 
 
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     text = update.message.text.strip().replace('\n', ' ')
     chat_id = update.effective_chat.id
-    now = time.time()
-
-    if chat_id in user_state and now - user_state[chat_id].get('timestamp', 0) > SESSION_TTL:
-        del user_state[chat_id]
-
-    state = user_state.get(chat_id, {})
+    session = sessions.get(chat_id)
+    kind = session.kind if session else None
 
     if text.lower() in ["b format", "/format", "/help"]:
         await show_help(update, context)
         return
 
     # === Handle reply with number (from "b", "p", or "u") ===
-    if 'awaiting_choice' in state and text.isdigit():
+    if kind is not None and text.isdigit():
         idx = int(text) - 1
-        matches = state.get('matches', [])
-        if 0 <= idx < len(matches):
-            await update.message.reply_text(format_entry(matches[idx]), parse_mode='Markdown')
-        del user_state[chat_id]
+        sessions.close(chat_id)
+        if 0 <= idx < len(session):
+            reply, priority = apply_choice(session, idx, chat_id)
+            await send_reply(update, reply, priority, parse_mode='Markdown')
+        elif kind != 'choice':
+            await send_reply(update, "❗ Invalid number.")
+        await clear_keyboard(session)
         return
 
-    if 'awaiting_pickup' in state and text.isdigit():
-        idx = int(text) - 1
-        matches = state.get('matches', [])
-        is_remove = state.get('is_remove', False)
-        if 0 <= idx < len(matches):
-            value = "" if is_remove else "Yes"
-            row = matches[idx]['row']
-            update_sheet_column(row, "Pickup", value)
-            name = row.get('Registrant First Name', '')
-            bag_no = row.get("Bag No.", "N/A")
-            status = "removed from pickup" if is_remove else "marked as picked up"
-            await update.message.reply_text(
-                f"✅ *{name}* {status}. For Bag No: *{bag_no}*.",
-                parse_mode='Markdown'
-            )
-        else:
-            await update.message.reply_text("❗ Invalid number.")
-        del user_state[chat_id]
-        return
-
-    if 'awaiting_checkin' in state and text.isdigit():
-        idx = int(text) - 1
-        matches = state.get('matches', [])
-        if 0 <= idx < len(matches):
-            row = matches[idx]['row']
-            value = "" if state.get('is_remove') else "No"
-            update_sheet_column(row, "Pickup", value)
-            name = row.get('Registrant First Name', '')
-            bag_no = row.get("Bag No.", "N/A")
-            status = "removed from pickup" if state.get('is_remove') else "marked as Checked In (No Pickup)"
-            await update.message.reply_text(
-                f"✅ *{name}* {status}. For Bag No: *{bag_no}*.",
-                parse_mode='Markdown'
-            )
-        else:
-            await update.message.reply_text("❗ Invalid number.")
-        del user_state[chat_id]
+    # === Handle "p 101 102 115-120" and "u [remove] ..." (several bags) ===
+    # A single bag takes the paths below, except `p remove <bag>`, which
+    # only exists here
+    bulk = text.lower().startswith(("p ", "u "))
+    is_remove = text.lower().startswith(("p remove ", "u remove "))
+    bags = parse_bag_list(text[9:] if is_remove else text[2:]) if bulk else None
+    if bags is not None and (len(bags) > 1 or text.lower().startswith("p remove ")):
+        await mark_bags(update, chat_id, text[0].lower(), bags, is_remove)
         return
 
     # === Handle "p <bag_number>" (numeric) ===
-    if text.lower().startswith("p ") and text[2:].strip().rstrip(".").isdigit():
-        bag_number = text[2:].strip().rstrip(".")
-        registration_data = await get_current_data()
-        matches = bag_match(bag_number, registration_data)
+    if text.lower().startswith("p ") and bags is not None:
+        bag_number = bags[0]
+        snapshot = get_current_data()
+        matches = bag_match(bag_number, snapshot)
     
         if not matches:
-            await update.message.reply_text(
+            await send_reply(
+                update,
                 f"❌ No match found for *Bag No. {bag_number}*.",
                 parse_mode='Markdown'
             )
             return
+
+        if len(matches) > 1:
+            await reply_duplicate_bag(update, bag_number, matches)
+            return
     
         row = matches[0]['row']
-        update_sheet_column(row, "Pickup", "Yes")
-        name = row.get('Registrant First Name', '')
-        await update.message.reply_text(
+        set_pickup(row, "Yes", chat_id)
+        name = row.first_name
+        await send_reply(
+            update,
             f"✅ *{name}* marked as picked up via Bag No: *{bag_number}*.",
-            parse_mode='Markdown'
+            parse_mode='Markdown',
+            priority=PRIORITY_CONFIRM
         )
         return
 
@@ -340,11 +662,12 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         tokens = query.strip().split()
         name, city = (tokens[0], None) if len(tokens) == 1 else (" ".join(tokens[:-1]), tokens[-1])
 
-        registration_data = await get_current_data()
-        matches = prefix_match(name, city, registration_data)
+        snapshot = get_current_data()
+        matches, reply = find_matches("p remove" if is_remove else "p", name, city, snapshot)
 
         if not matches:
-            await update.message.reply_text(
+            await send_reply(
+                update,
                 f"❌ No matches found for *{name}* in *{city or 'any city'}*.",
                 parse_mode='Markdown'
             )
@@ -352,35 +675,21 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
         value = "" if is_remove else "Yes"
 
-        if len(matches) == 1:
+        # A lone fuzzy guess still goes through the numbered list to confirm
+        if len(matches) == 1 and not is_fuzzy(matches):
             row = matches[0]['row']
-            update_sheet_column(row, "Pickup", value)
-            name = row.get("Registrant First Name", "")
-            bag_no = row.get("Bag No.", "N/A")
+            set_pickup(row, value, chat_id)
+            name = row.first_name
+            bag_no = row.bag_no or "N/A"
             status = "removed from pickup" if is_remove else "marked as picked up"
-            await update.message.reply_text(
+            await send_reply(
+                update,
                 f"✅ *{name}* {status}. For Bag No: *{bag_no}*.",
-                parse_mode='Markdown'
+                parse_mode='Markdown',
+                priority=PRIORITY_CONFIRM
             )
         else:
-            reply = f"🔎 *Found {len(matches)} possible matches:*\n\n"
-            for i, m in enumerate(matches, 1):
-                r = m['row']
-                full = f"{r.get('Registrant First Name', '')} {r.get('Registrant Last Name', '')}"
-                city_name = r.get('City', '?')
-                note = f" _(via family: {m['matched_family']})_" if m['via_family'] else ""
-                reply += f"{i}. *{full}* – {city_name}{note}\n"
-            reply += f"\n✉️ Reply with the number to {'remove' if is_remove else 'mark'} pickup."
-
-            await send_split_message(reply, update)
-            user_state[chat_id] = {
-                'awaiting_pickup': True,
-                'matches': matches,
-                'timestamp': now,
-                'is_remove': is_remove
-            }
-
-            asyncio.create_task(_timeout_clear(chat_id, context))
+            await send_match_list(update, chat_id, 'pickup', snapshot, matches, reply, is_remove)
         return
 
     # === Handle "u ..." and "u remove ..." ===
@@ -390,27 +699,34 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         query = query.strip().rstrip(".")
     
         # ✅ Check if input is just a Bag No
-        if query.isdigit():
-            bag_number = query
-            registration_data = await get_current_data()
-            matches = bag_match(bag_number, registration_data)
+        if bags is not None:
+            bag_number = bags[0]
+            snapshot = get_current_data()
+            matches = bag_match(bag_number, snapshot)
     
             if not matches:
-                await update.message.reply_text(
+                await send_reply(
+                    update,
                     f"❌ No match found for *Bag No. {bag_number}*.",
                     parse_mode='Markdown'
                 )
                 return
+
+            if len(matches) > 1:
+                await reply_duplicate_bag(update, bag_number, matches)
+                return
     
             row = matches[0]['row']
             value = "" if is_remove else "No"
-            update_sheet_column(row, "Pickup", value)
-            name = row.get("Registrant First Name", "")
-            bag_no = row.get("Bag No.", "N/A")
+            set_pickup(row, value, chat_id)
+            name = row.first_name
+            bag_no = row.bag_no or "N/A"
             status = "removed from pickup" if is_remove else "marked as Checked In (No Pickup)"
-            await update.message.reply_text(
+            await send_reply(
+                update,
                 f"✅ *{name}* {status}. For Bag No: *{bag_no}*.",
-                parse_mode='Markdown'
+                parse_mode='Markdown',
+                priority=PRIORITY_CONFIRM
             )
             return
     
@@ -418,11 +734,12 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         tokens = query.split()
         name, city = (tokens[0], None) if len(tokens) == 1 else (" ".join(tokens[:-1]), tokens[-1])
     
-        registration_data = await get_current_data()
-        matches = prefix_match(name, city, registration_data)
+        snapshot = get_current_data()
+        matches, reply = find_matches("u remove" if is_remove else "u", name, city, snapshot)
     
         if not matches:
-            await update.message.reply_text(
+            await send_reply(
+                update,
                 f"❌ No matches found for *{name}* in *{city or 'any city'}*.",
                 parse_mode='Markdown'
             )
@@ -430,35 +747,21 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
         value = "" if is_remove else "No"
     
-        if len(matches) == 1:
+        # A lone fuzzy guess still goes through the numbered list to confirm
+        if len(matches) == 1 and not is_fuzzy(matches):
             row = matches[0]['row']
-            update_sheet_column(row, "Pickup", value)
-            name = row.get("Registrant First Name", "")
-            bag_no = row.get("Bag No.", "N/A")
+            set_pickup(row, value, chat_id)
+            name = row.first_name
+            bag_no = row.bag_no or "N/A"
             status = "removed from pickup" if is_remove else "marked as Checked In (No Pickup)"
-            await update.message.reply_text(
+            await send_reply(
+                update,
                 f"✅ *{name}* {status}. For Bag No: *{bag_no}*.",
-                parse_mode='Markdown'
+                parse_mode='Markdown',
+                priority=PRIORITY_CONFIRM
             )
         else:
-            reply = f"🔎 *Found {len(matches)} possible matches:*\n\n"
-            for i, m in enumerate(matches, 1):
-                r = m['row']
-                full = f"{r.get('Registrant First Name', '')} {r.get('Registrant Last Name', '')}"
-                city_name = r.get('City', '?')
-                note = f" _(via family: {m['matched_family']})_" if m['via_family'] else ""
-                reply += f"{i}. *{full}* — {city_name}{note}\n"
-            reply += f"\n✉️ Reply with the number to mark as *Checked In (No Pickup)*."
-    
-            await send_split_message(reply, update)
-            user_state[chat_id] = {
-                'awaiting_checkin': True,
-                'matches': matches,
-                'timestamp': now,
-                'is_remove': is_remove
-            }
-    
-            asyncio.create_task(_timeout_clear(chat_id, context))
+            await send_match_list(update, chat_id, 'checkin', snapshot, matches, reply, is_remove)
         return
 
 
@@ -469,73 +772,144 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         # ✅ If it's a number, treat it as Bag No. lookup
         if query.isdigit():
             bag_number = query
-            registration_data = await get_current_data()
-            matches = bag_match(bag_number, registration_data)
+            snapshot = get_current_data()
+            matches = bag_match(bag_number, snapshot)
     
             if not matches:
-                await update.message.reply_text(
+                await send_reply(
+                    update,
                     f"❌ No registration found for *Bag No: {bag_number}*.",
                     parse_mode='Markdown'
                 )
                 return
+
+            if len(matches) > 1:
+                await reply_duplicate_bag(update, bag_number, matches)
+                return
     
-            await update.message.reply_text(format_entry(matches[0]), parse_mode='Markdown')
+            await send_reply(update, format_entry(matches[0]), parse_mode='Markdown')
             return
     
         # ✅ Otherwise, normal name + city match
         tokens = query.split()
         name, city = (tokens[0], None) if len(tokens) == 1 else (" ".join(tokens[:-1]), tokens[-1])
     
-        registration_data = await get_current_data()
-        matches = prefix_match(name, city, registration_data)
+        snapshot = get_current_data()
+        matches, reply = find_matches("b", name, city, snapshot)
     
         if not matches:
-            await update.message.reply_text(
+            await send_reply(
+                update,
                 f"❌ No matches found for *{name}* in *{city or 'any city'}*.",
                 parse_mode='Markdown'
             )
             return
     
         if len(matches) == 1:
-            await update.message.reply_text(format_entry(matches[0]), parse_mode='Markdown')
+            await send_reply(update, reply, parse_mode='Markdown')
         else:
-            reply = f"🔎 *Found {len(matches)} possible matches:*\n\n"
-            for i, m in enumerate(matches, 1):
-                r = m['row']
-                full = f"{r.get('Registrant First Name', '')} {r.get('Registrant Last Name', '')}"
-                city_name = r.get('City', '?')
-                attendees = r.get('Attendees', '?')
-                note = f" _(via family: {m['matched_family']})_" if m['via_family'] else ""
-                reply += f"{i}. *{full}* — {attendees} attendees – {city_name}{note}\n"
-            reply += "\n✉️ *Reply with the number to see full details.*"
-    
-            await send_split_message(reply, update)
-            user_state[chat_id] = {
-                'awaiting_choice': True,
-                'matches': matches,
-                'timestamp': now
-            }
-    
-            asyncio.create_task(_timeout_clear(chat_id, context))
+            await send_match_list(update, chat_id, 'choice', snapshot, matches, reply)
         return  # ✅ make sure to end this block
 
-    
 
-# === Helper timeout function ===
-async def _timeout_clear(chat_id, context):
-    await asyncio.sleep(SESSION_TTL)
-    if user_state.get(chat_id, {}).get('timestamp'):
-        await context.bot.send_message(chat_id, "⏳ Timeout. Send a new query.")
-        user_state.pop(chat_id, None)
 
+# === Inline buttons on match lists ===
+# "pick:<seq>:<idx>" acts on a name, "page:<seq>:<page>" flips the list. Both
+# work off the open session, so paging never re-runs the search. Edits go
+# through the outbox like any send; answering the callback query is not a
+# chat message, so it goes straight to Telegram.
+async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    action, token, value = query.data.split(":", 2)
+    chat_id = update.effective_chat.id
+    session = sessions.get(chat_id)
+    if session is None or str(session.seq) != token or not value.isdigit():
+        await query.answer("⏳ This list has expired. Send a new query.")
+        return
+
+    if action == "page":
+        page = int(value)
+        await query.answer()
+        # A repeated tap on the same button would be an edit that changes
+        # nothing, which Telegram rejects
+        if page == session.page or not 0 <= page < page_count(len(session)) or session.message_id is None:
+            return
+        # Someone paging through the list is still using it
+        sessions.touch(session)
+        session.page = page
+        try:
+            await outbox.edit(
+                chat_id, session.message_id,
+                render_session_page(session, page),
+                parse_mode='Markdown',
+                reply_markup=match_keyboard(session, page)
+            )
+        except BadRequest as e:
+            print(f"⚠️ Could not turn the page in {chat_id}: {e}")
+        return
 
+    idx = int(value)
+    sessions.close(chat_id)
+    await query.answer()
+    if 0 <= idx < len(session):
+        reply, priority = apply_choice(session, idx, chat_id)
+        await send_reply(update, reply, priority, parse_mode='Markdown')
+    await clear_keyboard(session)
+
+
+# === Startup / graceful drain ===
+# Time from the previous instance's shutdown to this one taking over
+handover_gap = None
+
+async def on_startup(app):
+    global handover_gap
+    # Marks the previous run accepted but could not get to the sheet
+    pickup_writes.restore(warm_state.pop('writes', []))
+    stopped_at = warm_state.pop('stopped_at', None)
+    if stopped_at is not None:
+        handover_gap = time.time() - stopped_at
+        print(f"🔀 Took over {handover_gap:.1f}s after the previous instance stopped.")
+    store.start_background_refresh(SHEET_REFRESH_SECONDS)
+    sessions.start()
+    warm_cache.start_autosave(warm_state_now, WARM_CACHE_SECONDS)
+
+async def on_stop(app):
+    # Runs once polling has stopped and every fetched update was handled, while
+    # the bot can still send messages. Pending writes get most of the deadline;
+    # whatever doesn't reach the sheet is saved with the sessions for the next
+    # instance to send.
+    started = time.time()
+    await store.stop_background_refresh()
+    await sessions.stop()
+    await warm_cache.stop_autosave()
+    failed = await pickup_writes.drain(max(1.0, SHUTDOWN_DEADLINE_SECONDS - 2))
+    await warm_cache.save(dict(warm_state_now(), stopped_at=started))
+    print(
+        f"🛑 Drained in {time.time() - started:.1f}s: {len(sessions)} sessions saved, "
+        f"{len(failed)} pickup writes handed over."
+    )
+
+async def on_shutdown(app):
+    sheets.close(wait=False)
 
 
 # === App Init ===
-app = ApplicationBuilder().token(TELEGRAM_TOKEN).build()
+app = (
+    serving.application_builder(TELEGRAM_TOKEN)
+    .concurrent_updates(ChatOrderedUpdateProcessor(CONCURRENT_UPDATES))
+    .post_init(on_startup)
+    .post_stop(on_stop)
+    .post_shutdown(on_shutdown)
+    .build()
+)
+# Flood-limit aware sender for everything the bot says; see outbox.py
+outbox = Outbox(app.bot)
 app.add_handler(CommandHandler("start", start))
 app.add_handler(CommandHandler("help", show_help))
 app.add_handler(CommandHandler("format", show_help))
 app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
+app.add_handler(CallbackQueryHandler(handle_callback, pattern=r"^(pick|page):"))
 app.add_handler(CommandHandler("summary", show_summary))
-app.run_polling()
+app.add_handler(CommandHandler("stats", show_stats))
+app.add_handler(CommandHandler("inventory", show_inventory))
+serving.run(app)
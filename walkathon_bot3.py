@@ -5,11 +5,14 @@ import asyncio
 from dotenv import load_dotenv
 from telegram import Update
 from telegram.ext import (
-    ApplicationBuilder, ContextTypes,
+    ContextTypes,
     CommandHandler, MessageHandler, filters
 )
+import serving
 import gspread
-from decrypt_utils import decrypt_file,decrypt_and_load_json
+from decrypt_utils import EncryptedDataWatcher
+from registration_store import RegistrationStore, rows_from_dicts
+from outbox import split_message
 
 
 # === Load env + decrypt data ===
@@ -19,8 +22,16 @@ GPG_PASSPHRASE = os.getenv("GPG_PASSPHRASE")
 SERVICE_ACCOUNT_JSON = os.getenv("GOOGLE_SERVICE_ACCOUNT_JSON")
 SHEET_ID = os.getenv("GOOGLE_SHEET_ID")
 SHEET_NAME = os.getenv("SHEET_NAME")
+DATA_RELOAD_SECONDS = int(os.getenv("DATA_RELOAD_SECONDS", "60"))
 
-registration_data = decrypt_and_load_json(GPG_PASSPHRASE)
+# Re-read whenever the sync workflow's new ciphertext lands on disk; lookups
+# keep using the old snapshot until the new one is fully indexed
+data_watcher = EncryptedDataWatcher(GPG_PASSPHRASE)
+
+async def reload_if_changed():
+    return await data_watcher.changed(rows_from_dicts)
+
+store = RegistrationStore(reload_if_changed, data_watcher.load())
 
 # === Google Sheet Setup ===
 gc = gspread.service_account(filename=os.getenv("SERVICE_ACCOUNT_FILE"))
@@ -32,57 +43,15 @@ user_state = {}  # chat_id -> dict(state)
 SESSION_TTL = 30  # seconds
 MAX_MSG_LENGTH = 4000  # Telegram safe limit
 
-def prefix_match(name, city, data):
-    name_lower = name.lower()
-    direct = []
-    family = []
-
-    for row in data:
-        r_city = row.get('City', '').lower()
-        r_fname = row.get('Registrant First Name', '').lower()
-        r_lname = row.get('Registrant Last Name', '').lower()
-        full_name = f"{r_fname} {r_lname}"
-
-        if city and not r_city.startswith(city.lower()):
-            continue
-
-        if (
-            r_fname.startswith(name_lower)
-            or r_lname.startswith(name_lower)
-            or full_name.startswith(name_lower)
-        ):
-            direct.append({'row': row, 'via_family': False, 'matched_family': None})
-            continue
-
-        for line in row.get('Additional Family Members', '').split('\n'):
-            if line.strip().lower().startswith(name_lower):
-                family.append({'row': row, 'via_family': True, 'matched_family': line.strip()})
-                break
-
-    return sorted(direct + family, key=lambda x: x['row'].get('Registrant First Name', ''))
-
-def extract_shirt_info(row):
-    sizes = ["SM", "MD", "LG", "XL", "XXL", "Y-LG", "Y-MD", "Y-SM", "Y-XS"]
-    shirt_counts = {}
-    for size in sizes:
-        count = row.get(size)
-        try:
-            count = int(count) if count is not None else 0
-        except ValueError:
-            count = 0
-        if count > 0:
-            shirt_counts[size] = count
-    return shirt_counts
-
 def format_entry(entry):
     row = entry['row']
-    full_name = f"{row.get('Registrant First Name', '')} {row.get('Registrant Last Name', '')}"
-    attendees = row.get('Attendees', '?')
-    city = row.get('City', 'Unknown')
-    family = row.get('Additional Family Members', 'None').strip()
-    bag_no = row.get('Bag No.', 'N/A')
-    shirts = extract_shirt_info(row)
-    total_shirts = sum(shirts.values())
+    full_name = row.full_name
+    attendees = row.attendees if row.attendees is not None else '?'
+    city = row.city or 'Unknown'
+    family = "\n".join(row.family)
+    bag_no = row.bag_no or 'N/A'
+    shirts = row.shirts
+    total_shirts = row.total_shirts
 
     response = f"""✅ *{full_name}* is registered.
 📍 *City:* {city}
@@ -92,7 +61,7 @@ def format_entry(entry):
 
     if shirts:
         response += "\n\n👕 *T-Shirts Ordered:*\n"
-        for size, count in shirts.items():
+        for size, count in shirts:
             response += f"- {size}: {count}\n"
         response += f"\n📦 *Total T-Shirts:* {total_shirts}"
     else:
@@ -110,9 +79,9 @@ def update_pickup_column(row, value):
         all_data = worksheet.get_all_records()
         for idx, r in enumerate(all_data, start=2):
             if (
-                r.get('Registrant First Name') == row.get('Registrant First Name')
-                and r.get('Registrant Last Name') == row.get('Registrant Last Name')
-                and r.get('City') == row.get('City')
+                r.get('Registrant First Name') == row.first_name
+                and r.get('Registrant Last Name') == row.last_name
+                and r.get('City') == row.city
             ):
                 worksheet.update_cell(idx, list(r.keys()).index("Pickup") + 1, value)
                 return True
@@ -121,20 +90,7 @@ def update_pickup_column(row, value):
     return False
 
 async def send_split_message(text, update):
-    lines = text.strip().split('\n')
-    chunks = []
-    current = ""
-
-    for line in lines:
-        if len(current) + len(line) + 1 < MAX_MSG_LENGTH:
-            current += line + "\n"
-        else:
-            chunks.append(current.strip())
-            current = line + "\n"
-    if current:
-        chunks.append(current.strip())
-
-    for chunk in chunks:
+    for chunk in split_message(text, MAX_MSG_LENGTH):
         await update.message.reply_text(chunk, parse_mode='Markdown')
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -199,7 +155,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if 0 <= idx < len(matches):
             value = "" if is_remove else "Yes"
             update_pickup_column(matches[idx]['row'], value)
-            name = matches[idx]['row'].get('Registrant First Name', '')
+            name = matches[idx]['row'].first_name
             await update.message.reply_text(
                 f"✅ *{name}* {'removed from' if is_remove else 'marked for'} pickup.",
                 parse_mode='Markdown'
@@ -217,7 +173,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
         print(f"🧪 Parsed → name: '{name}' | city: '{city}' | remove: {is_remove}")
 
-        matches = prefix_match(name, city, registration_data)
+        matches = store.snapshot.names.prefix_match(name, city)
         if not matches:
             await update.message.reply_text(
                 f"❌ No matches found for *{name}* in *{city or 'any city'}*.",
@@ -237,8 +193,8 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
             reply = f"🔎 *Found {len(matches)} possible matches:*\n\n"
             for i, m in enumerate(matches, 1):
                 r = m['row']
-                full = f"{r.get('Registrant First Name', '')} {r.get('Registrant Last Name', '')}"
-                city_name = r.get('City', '?')
+                full = r.full_name
+                city_name = r.city or '?'
                 note = f" _(via family: {m['matched_family']})_" if m['via_family'] else ""
                 reply += f"{i}. *{full}* – {city_name}{note}\n"
             reply += f"\n✉️ Reply with the number to {'remove' if is_remove else 'mark'} pickup."
@@ -265,7 +221,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     tokens = text[2:].strip().split()
     name, city = (tokens[0], None) if len(tokens) == 1 else (" ".join(tokens[:-1]), tokens[-1])
-    matches = prefix_match(name, city, registration_data)
+    matches = store.snapshot.names.prefix_match(name, city)
 
     if not matches:
         await update.message.reply_text(
@@ -280,9 +236,9 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         reply = f"🔎 *Found {len(matches)} possible matches:*\n\n"
         for i, m in enumerate(matches, 1):
             r = m['row']
-            full = f"{r.get('Registrant First Name', '')} {r.get('Registrant Last Name', '')}"
-            city_name = r.get('City', '?')
-            attendees = r.get('Attendees', '?')
+            full = r.full_name
+            city_name = r.city or '?'
+            attendees = r.attendees if r.attendees is not None else '?'
             note = f" _(via family: {m['matched_family']})_" if m['via_family'] else ""
             reply += f"{i}. *{full}* — {attendees} attendees – {city_name}{note}\n"
         reply += "\n✉️ *Reply with the number to see full details.*"
@@ -302,10 +258,13 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
         asyncio.create_task(timeout_clear())
 
+async def on_startup(app):
+    store.start_background_refresh(DATA_RELOAD_SECONDS)
+
 # === App Init ===
-app = ApplicationBuilder().token(TELEGRAM_TOKEN).build()
+app = serving.application_builder(TELEGRAM_TOKEN).post_init(on_startup).build()
 app.add_handler(CommandHandler("start", start))
 app.add_handler(CommandHandler("help", show_help))
 app.add_handler(CommandHandler("format", show_help))
 app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
-app.run_polling()
+serving.run(app)
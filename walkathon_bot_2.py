@@ -1,93 +1,47 @@
 import os
-import json
 import time
 import asyncio
 from dotenv import load_dotenv
 from telegram import Update
 from telegram.ext import (
-    ApplicationBuilder, ContextTypes,
+    ContextTypes,
     CommandHandler, MessageHandler, filters
 )
-from decrypt_utils import decrypt_file
+import serving
+from decrypt_utils import EncryptedDataWatcher
+from registration_store import RegistrationStore, rows_from_dicts
+from outbox import split_message
 
 # === Load env + decrypt data ===
 load_dotenv()
 TELEGRAM_TOKEN = os.getenv("TELEGRAM_TOKEN")
 GPG_PASSPHRASE = os.getenv("GPG_PASSPHRASE")
+DATA_RELOAD_SECONDS = int(os.getenv("DATA_RELOAD_SECONDS", "60"))
 
-decrypted_path = decrypt_file(GPG_PASSPHRASE)
-with open(decrypted_path, 'r') as f:
-    registration_data = json.load(f)
+# Re-read whenever the sync workflow's new ciphertext lands on disk; lookups
+# keep using the old snapshot until the new one is fully indexed
+data_watcher = EncryptedDataWatcher(GPG_PASSPHRASE)
+
+async def reload_if_changed():
+    return await data_watcher.changed(rows_from_dicts)
+
+store = RegistrationStore(reload_if_changed, data_watcher.load())
 
 # === Globals ===
 user_state = {}  # chat_id -> dict(state)
 SESSION_TTL = 30  # seconds
 MAX_MSG_LENGTH = 4000  # Telegram safe limit
 
-# === Matching Logic ===
-def prefix_match(name, city, data):
-    name_lower = name.lower()
-    direct = []
-    family = []
-
-    for row in data:
-        r_city = row.get('City', '').lower()
-        r_fname = row.get('Registrant First Name', '').lower()
-        r_lname = row.get('Registrant Last Name', '').lower()
-        full_name = f"{r_fname} {r_lname}"
-
-        # Case 1: If city is specified
-        if city:
-            if not r_city.startswith(city.lower()):
-                continue
-
-        # Match direct registrant
-        if (
-            r_fname.startswith(name_lower)
-            or r_lname.startswith(name_lower)
-            or full_name.startswith(name_lower)
-        ):
-            direct.append({'row': row, 'via_family': False, 'matched_family': None})
-            continue
-
-        # Match in additional family members
-        matched_line = None
-        for line in row.get('Additional Family Members', '').split('\n'):
-            if line.strip().lower().startswith(name_lower):
-                matched_line = line.strip()
-                break
-        if matched_line:
-            family.append({'row': row, 'via_family': True, 'matched_family': matched_line})
-
-    return sorted(direct + family, key=lambda x: x['row'].get('Registrant First Name', ''))
-
-
-
-def extract_shirt_info(row):
-    sizes = ["SM", "MD", "LG", "XL", "XXL", "Y-LG", "Y-MD", "Y-SM", "Y-XS"]
-    shirt_counts = {}
-    for size in sizes:
-        count = row.get(size)
-        try:
-            count = int(count) if count is not None else 0
-        except ValueError:
-            count = 0
-        if count > 0:
-            shirt_counts[size] = count
-    return shirt_counts
-
-
-
 # === Format Result Entry ===
 def format_entry(entry):
     row = entry['row']
-    full_name = f"{row.get('Registrant First Name', '')} {row.get('Registrant Last Name', '')}"
-    attendees = row.get('Attendees', '?')
-    city = row.get('City', 'Unknown')
-    family = row.get('Additional Family Members', 'None').strip()
-    bag_no = row.get('Bag No.', 'N/A')  # <- Read from your new column
-    shirts = extract_shirt_info(row)
-    total_shirts = sum(shirts.values())
+    full_name = row.full_name
+    attendees = row.attendees if row.attendees is not None else '?'
+    city = row.city or 'Unknown'
+    family = "\n".join(row.family)
+    bag_no = row.bag_no or 'N/A'
+    shirts = row.shirts
+    total_shirts = row.total_shirts
 
     response = f"""✅ *{full_name}* is registered.
 📍 *City:* {city}
@@ -98,7 +52,7 @@ def format_entry(entry):
     # T-shirt summary
     if shirts:
         response += "\n\n👕 *T-Shirts Ordered:*\n"
-        for size, count in shirts.items():
+        for size, count in shirts:
             response += f"- {size}: {count}\n"
         response += f"\n📦 *Total T-Shirts:* {total_shirts}"
     else:
@@ -117,20 +71,7 @@ def format_entry(entry):
 
 # === Smart Chunked Message Sender ===
 async def send_split_message(text, update):
-    lines = text.strip().split('\n')
-    chunks = []
-    current = ""
-
-    for line in lines:
-        if len(current) + len(line) + 1 < MAX_MSG_LENGTH:
-            current += line + "\n"
-        else:
-            chunks.append(current.strip())
-            current = line + "\n"
-    if current:
-        chunks.append(current.strip())
-
-    for chunk in chunks:
+    for chunk in split_message(text, MAX_MSG_LENGTH):
         await update.message.reply_text(chunk, parse_mode='Markdown')
 
 # === Command: /start ===
@@ -200,7 +141,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         name, city = " ".join(tokens[:-1]), tokens[-1]
 
     print(f"🔍 Query received: name='{name}' | city='{city}'")
-    matches = prefix_match(name, city, registration_data)
+    matches = store.snapshot.names.prefix_match(name, city)
 
     if not matches:
         print("❌ No match found.")
@@ -217,9 +158,9 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         reply = f"🔎 *Found {len(matches)} possible matches:*\n\n"
         for i, m in enumerate(matches, 1):
             r = m['row']
-            full = f"{r.get('Registrant First Name', '')} {r.get('Registrant Last Name', '')}"
-            city_name = r.get('City', '?')
-            attendees = r.get('Attendees', '?')
+            full = r.full_name
+            city_name = r.city or '?'
+            attendees = r.attendees if r.attendees is not None else '?'
             note = f" _(via family: {m['matched_family']})_" if m['via_family'] else ""
             reply += f"{i}. *{full}* — {attendees} attendees – {city_name}{note}\n"
 
@@ -241,8 +182,11 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
         asyncio.create_task(timeout_clear())
 
+async def on_startup(app):
+    store.start_background_refresh(DATA_RELOAD_SECONDS)
+
 # === App Init ===
-app = ApplicationBuilder().token(TELEGRAM_TOKEN).build()
+app = serving.application_builder(TELEGRAM_TOKEN).post_init(on_startup).build()
 app.add_handler(CommandHandler("start", start))
 app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
-app.run_polling()
+serving.run(app)
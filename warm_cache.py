@@ -0,0 +1,114 @@
+import asyncio
+import os
+import pickle
+import time
+
+import gnupg
+
+
+CACHE_FORMAT = 6  # bump when the pickled classes change shape
+
+
+# === Warm-start cache ===
+# The last snapshot's headers and rows, open sessions and pending writes,
+# pickled and encrypted with the same GPG passphrase as
+# encrypted_data.json.gpg. A restart loads this instead of decrypting the JSON
+# (the snapshot rebuilds its indexes on load), serves from it straight away,
+# and lets the background refresh reconcile with the sheet.
+class WarmCache:
+    def __init__(self, path, passphrase):
+        self.path = path
+        self.passphrase = passphrase
+        self._gpg = gnupg.GPG()
+        self._autosave_task = None
+        self._writing = None  # the worker-thread write in progress
+        self._saved_version = None
+        self.saves = 0
+
+    def load(self):
+        # Returns the saved state dict, or None if there is no usable cache
+        if not self.path or not os.path.exists(self.path):
+            return None
+        try:
+            with open(self.path, 'rb') as f:
+                decrypted = self._gpg.decrypt_file(
+                    f,
+                    passphrase=self.passphrase,
+                    extra_args=["--pinentry-mode", "loopback"]
+                )
+            if not decrypted.ok:
+                raise Exception(f"GPG Decryption Failed: {decrypted.stderr}")
+            state = pickle.loads(decrypted.data)
+        except Exception as e:
+            print(f"⚠️ Ignoring warm-start cache: {e}")
+            return None
+        if state.get('format') != CACHE_FORMAT:
+            print("⚠️ Ignoring warm-start cache from another bot version.")
+            return None
+        return state
+
+    def _write(self, state):
+        payload = pickle.dumps(state, protocol=pickle.HIGHEST_PROTOCOL)
+        encrypted = self._gpg.encrypt(
+            payload, None,
+            symmetric=True,
+            passphrase=self.passphrase,
+            armor=False,
+            extra_args=["--pinentry-mode", "loopback"]
+        )
+        if not encrypted.ok:
+            raise Exception(f"GPG Encryption Failed: {encrypted.status}")
+        # Written aside and renamed, so a kill mid-save leaves the old cache intact
+        tmp = f"{self.path}.tmp"
+        with open(tmp, 'wb') as f:
+            f.write(encrypted.data)
+        os.replace(tmp, self.path)
+
+    async def save(self, state):
+        # Pickling, encryption and the file write all run in a worker thread.
+        # The snapshot pickles as a copy of its row list (no indexes), so this
+        # is cheap and a mark landing meanwhile is either in or out.
+        if not self.path:
+            return
+        state = dict(state, format=CACHE_FORMAT, saved_at=time.time())
+        await self._wait_for_write()
+        try:
+            loop = asyncio.get_running_loop()
+            self._writing = loop.run_in_executor(None, self._write, state)
+            # Shielded: cancelling the autosave can't stop the thread, so the
+            # write stays tracked until it has really finished
+            await asyncio.shield(self._writing)
+            self.saves += 1
+        except Exception as e:
+            print(f"❌ Could not save warm-start cache: {e}")
+
+    async def _wait_for_write(self):
+        # An older state must never be renamed over a newer one
+        if self._writing is not None and not self._writing.done():
+            await asyncio.wait({self._writing})
+
+    async def _autosave_loop(self, collect, interval):
+        while True:
+            await asyncio.sleep(interval)
+            state = collect()
+            # Skip the save if nothing has changed since the last one
+            marker = state['snapshot'].version, len(state.get('sessions', ()))
+            if marker != self._saved_version:
+                await self.save(state)
+                self._saved_version = marker
+
+    def start_autosave(self, collect, interval):
+        # `collect()` returns the state dict to persist
+        if self._autosave_task is None or self._autosave_task.done():
+            self._autosave_task = asyncio.create_task(self._autosave_loop(collect, interval))
+        return self._autosave_task
+
+    async def stop_autosave(self):
+        if self._autosave_task is not None:
+            self._autosave_task.cancel()
+            try:
+                await self._autosave_task
+            except asyncio.CancelledError:
+                pass
+            self._autosave_task = None
+        await self._wait_for_write()
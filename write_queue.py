@@ -0,0 +1,185 @@
+import asyncio
+import time
+
+from registration_store import PICKUP_COLUMN
+
+
+class PendingWrite:
+    __slots__ = ('row', 'column', 'value', 'original', 'chat_ids')
+
+    def __init__(self, row, value, original):
+        self.row = row
+        self.column = PICKUP_COLUMN
+        self.value = value
+        self.original = original
+        self.chat_ids = set()
+
+
+# === Write-behind queue ===
+# Pickup marks are applied to the in-memory snapshot straight away and sent
+# to the sheet in one batch after `window` seconds. Writes to the same row
+# inside a window collapse to the last value, and a toggle that ends where it
+# started (`p` then `p remove`) is dropped without touching the sheet.
+# Sent writes stay "unconfirmed" until a snapshot read after the batch landed
+# is swapped in, so a refresh that raced the write can't undo the mark.
+class PickupWriteQueue:
+    def __init__(self, store, flush, on_failure=None, window=1.0):
+        self.store = store
+        self.window = window
+        self._flush = flush            # async fn(list[PendingWrite]) -> list of failed writes
+        self._on_failure = on_failure  # async fn(chat_id, list[PendingWrite])
+        self._pending = {}
+        self._unconfirmed = {}  # row -> (write, time its batch finished, None while sending)
+        self._inflight = None   # (batch, future) the timer's flush is sending
+        self._draining = False
+        self._timer = None
+        self.enqueued = 0
+        self.sent = 0
+        self.flushes = 0
+        store.add_listener(self._reapply)
+
+    def __len__(self):
+        return len(self._pending)
+
+    def enqueue(self, row, value, chat_id=None):
+        # Keyed by the current snapshot's row, so a mark made from an older
+        # list and one made from a fresh lookup collapse into one write.
+        # Rows sharing a name and city stay separate writes.
+        row = self.store.counterpart(row) or row
+        pending = self._pending.get(row)
+        if pending is None:
+            pending = self._pending[row] = PendingWrite(row, value, row.pickup)
+        pending.value = value
+        if chat_id is not None:
+            pending.chat_ids.add(chat_id)
+        self.enqueued += 1
+        self.store.patch_pickup(row, value)
+        if self._timer is None or self._timer.done():
+            self._timer = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self):
+        # Marks made while a batch was being written go out in the next one
+        while self._pending and not self._draining:
+            await asyncio.sleep(self.window)
+            await self.flush()
+
+    async def flush(self):
+        batch = [w for w in self._pending.values() if w.value != w.original]
+        self._pending = {}
+        if not batch:
+            return []
+        self.flushes += 1
+        sending = asyncio.ensure_future(self._send(batch))
+        self._inflight = (batch, sending)
+        try:
+            # Shielded: drain() waits for this batch instead of cancelling it
+            failed = await asyncio.shield(sending)
+        finally:
+            self._inflight = None
+        if self._draining:
+            # drain() hands these to the next instance instead
+            return failed
+
+        by_chat = {}
+        for write in failed:
+            # Roll the optimistic value back unless a newer write already replaced it
+            if write.row.pickup == write.value:
+                self.store.patch_pickup(write.row, write.original)
+            for chat_id in write.chat_ids:
+                by_chat.setdefault(chat_id, []).append(write)
+        if self._on_failure:
+            for chat_id, writes in by_chat.items():
+                try:
+                    await self._on_failure(chat_id, writes)
+                except Exception as e:
+                    print(f"❌ Could not report failed write to {chat_id}: {e}")
+        return failed
+
+    async def _send(self, batch):
+        # Returns the writes that didn't land
+        for write in batch:
+            self._unconfirmed[write.row] = (write, None)
+        try:
+            failed = await self._flush(batch)
+        except Exception as e:
+            print(f"❌ Pickup batch write failed: {e}")
+            failed = batch
+        self.sent += len(batch) - len(failed)
+        finished = time.time()
+        failed_ids = {id(write) for write in failed}
+        for write in batch:
+            self._unconfirm(write, None if id(write) in failed_ids else finished)
+        return failed
+
+    async def drain(self, timeout):
+        # Final flush at shutdown, bounded by `timeout`. Unlike flush(), writes
+        # that fail or don't finish in time are not rolled back; they stay
+        # pending so export() can hand them to the next instance. Re-sending a
+        # write that did land is harmless, it sets the same value again.
+        # Returns the writes handed over.
+        self._draining = True
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        carried = []
+        if self._inflight is not None:
+            # The timer's batch is already on its way; let it finish
+            inflight, sending = self._inflight
+            await asyncio.wait({sending}, timeout=timeout)
+            if not sending.done():
+                print(f"⚠️ Pickup batch write did not finish within {timeout:.1f}s")
+                carried = inflight
+            else:
+                carried = sending.result()
+        elif self._timer is not None and not self._timer.done():
+            self._timer.cancel()
+
+        batch = [w for w in self._pending.values() if w.value != w.original]
+        self._pending = {}
+        failed = []
+        if batch:
+            self.flushes += 1
+            remaining = deadline - loop.time()
+            try:
+                failed = await asyncio.wait_for(self._send(batch), max(remaining, 0))
+            except asyncio.TimeoutError:
+                print(f"⚠️ Pickup batch write did not finish within {timeout:.1f}s")
+                failed = batch
+        # A newer write to the same row supersedes the in-flight one
+        newer = {w.row for w in batch}
+        handed_over = [w for w in carried if w.row not in newer] + failed
+        self._pending = {w.row: w for w in handed_over}
+        return handed_over
+
+    def export(self):
+        return list(self._pending.values())
+
+    def restore(self, writes):
+        # Writes handed over by a previous instance; sent with the next batch
+        for write in writes:
+            self._pending[write.row] = write
+            self.store.patch_pickup(write.row, write.value)
+        if self._pending and (self._timer is None or self._timer.done()):
+            self._timer = asyncio.create_task(self._flush_later())
+
+    def _unconfirm(self, write, finished):
+        # Record when `write` landed, or forget it if it failed. A newer write
+        # to the same row may have taken its place already.
+        entry = self._unconfirmed.get(write.row)
+        if entry is None or entry[0] is not write:
+            return
+        if finished is None:
+            del self._unconfirmed[write.row]
+        else:
+            self._unconfirmed[write.row] = (write, finished)
+
+    def _reapply(self, snapshot):
+        # A refresh may land before the batch is flushed, or may have read the
+        # sheet before a sent batch landed; keep the values we wrote until a
+        # read that started after that.
+        for row, (write, finished) in list(self._unconfirmed.items()):
+            if finished is not None and snapshot.loaded_at > finished:
+                del self._unconfirmed[row]
+            else:
+                self.store.patch_pickup(write.row, write.value)
+        for write in self._pending.values():
+            self.store.patch_pickup(write.row, write.value)